@@ -0,0 +1,6 @@
+'''
+Benchmarks
+Drive FuseOperations in process, without a kernel mount, against local
+and memory backends, or bpan against a stand-in PCS server, results are
+written as JSON lines
+'''
@@ -0,0 +1,142 @@
+'''
+Run benchmarks, e.g.
+python3 -m benchmark -b local,memory -n 10000 -o results.jsonl
+python3 -m benchmark -b bpan --latency 0.05 --upload-bandwidth 1048576
+'''
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import ast
+import json
+import sys
+from contextlib import contextmanager
+from timeit import default_timer
+from .cases import CASES
+from .pcsserver import PCSServer
+from .volume import Volume
+
+
+class Scale:
+    def __init__(self, args):
+        self.files = args.files
+        self.size = args.size
+        self.io_size = args.io_size
+        self.small_size = args.small_size
+        self.random_size = args.random_size
+        self.random_ops = args.random_ops
+
+
+def parse_option(argument):
+    key, value = argument.split('=', 1)
+    try:
+        value = ast.literal_eval(value)
+    except (SyntaxError, ValueError):
+        pass
+    return key, value
+
+
+def run(backend, case, args, output, server=None):
+    if backend == 'bpan':
+        volume = Volume(
+            backend, ','.join(filter(None, (
+                args.mount_arguments, 'base_url=' + server.url))),
+            'benchmark', **dict(args.option))
+    else:
+        volume = Volume(backend, args.mount_arguments, **dict(args.option))
+
+    @contextmanager
+    def measure(name, ops, nbytes=0):
+        start = default_timer()
+        yield
+        seconds = default_timer() - start
+        json.dump({
+            'name': name,
+            'case': case,
+            'backend': backend,
+            'ops': ops,
+            'bytes': nbytes,
+            'seconds': seconds,
+            'ops_per_second': seconds and ops / seconds,
+            'bytes_per_second': seconds and nbytes / seconds,
+        }, output, sort_keys=True)
+        output.write('\n')
+        output.flush()
+
+    try:
+        CASES[case](volume, Scale(args), measure)
+    finally:
+        volume.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m benchmark',
+        description='Benchmark FuseOperations without a kernel mount.')
+    parser.add_argument(
+        '-b', '--backends', default='local,memory',
+        help='comma separated backends (default: %(default)s)')
+    parser.add_argument(
+        '-c', '--cases', default=','.join(CASES),
+        help='comma separated cases (default: %(default)s)')
+    parser.add_argument(
+        '-n', '--files', type=int, default=10000,
+        help='number of files in metadata cases (default: %(default)s)')
+    parser.add_argument(
+        '-s', '--size', type=int, default=1 << 26,
+        help='size of file in data cases (default: %(default)s)')
+    parser.add_argument(
+        '--io-size', type=int, default=1 << 17,
+        help='size of sequential reads and writes (default: %(default)s)')
+    parser.add_argument(
+        '--small-size', type=int, default=1 << 10,
+        help='size of files in churn case (default: %(default)s)')
+    parser.add_argument(
+        '--random-size', type=int, default=1 << 12,
+        help='size of random reads and writes (default: %(default)s)')
+    parser.add_argument(
+        '--random-ops', type=int, default=10000,
+        help='number of random reads and writes (default: %(default)s)')
+    parser.add_argument(
+        '-m', '--mount-arguments', default='',
+        help='arguments passed to backends, as in mount.cpfs -o')
+    parser.add_argument(
+        '--option', type=parse_option, action='append', default=[],
+        metavar='KEY=VALUE', help='option of FuseOperations')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds every request to stand-in PCS server waits')
+    parser.add_argument(
+        '--upload-bandwidth', type=int, default=0,
+        help='bytes per second of uploads to stand-in PCS server')
+    parser.add_argument(
+        '--download-bandwidth', type=int, default=0,
+        help='bytes per second of downloads from stand-in PCS server')
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='probability a request to stand-in PCS server fails')
+    parser.add_argument(
+        '-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+        help='file results are written to (default: stdout)')
+    args = parser.parse_args()
+
+    for case in args.cases.split(','):
+        if case not in CASES:
+            parser.error('unknown case: {}'.format(case))
+    backends = args.backends.split(',')
+    server = None
+    if 'bpan' in backends:
+        server = PCSServer(
+            latency=args.latency, upload_bandwidth=args.upload_bandwidth,
+            download_bandwidth=args.download_bandwidth,
+            error_rate=args.error_rate).start()
+    try:
+        for backend in backends:
+            for case in args.cases.split(','):
+                run(backend, case, args, args.output, server)
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
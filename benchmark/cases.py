@@ -0,0 +1,154 @@
+'''
+Cases
+Each case mounts the volume itself, prepares what it needs untimed, and
+times operations through measure(name, ops, nbytes)
+'''
+from __future__ import absolute_import, division
+
+import os
+import random
+from collections import OrderedDict
+from stat import S_IFDIR, S_IFREG
+from .volume import Context
+
+FILE_MODE = S_IFREG | 0o644
+DIR_MODE = S_IFDIR | 0o755
+# flags of files opened by cases
+OPEN_FLAGS = os.O_RDWR
+
+
+def _name(index):
+    return 'f{}'.format(index).encode()
+
+
+def _mkdir(fuse_op, name):
+    return fuse_op.mkdir(1, name, DIR_MODE, Context()).st_ino
+
+
+def _create(fuse_op, inode_parent, name):
+    fh, inode_i = fuse_op.create(
+        inode_parent, name, FILE_MODE, os.O_CREAT | OPEN_FLAGS, Context())
+    return fh, inode_i.st_ino
+
+
+def _close(fuse_op, fh):
+    '''Flush before release as the kernel does, size is saved on flush'''
+    fuse_op.flush(fh)
+    fuse_op.release(fh)
+
+
+def metadata(volume, scale, measure):
+    '''create, lookup, getattr storms and readdir of one large directory'''
+    fuse_op = volume.mount()
+    inode_dir = _mkdir(fuse_op, b'metadata')
+    list_inodes = []
+    with measure('create', scale.files):
+        for index in range(scale.files):
+            fh, inode = _create(fuse_op, inode_dir, _name(index))
+            _close(fuse_op, fh)
+            list_inodes.append(inode)
+    with measure('lookup', scale.files):
+        for index in range(scale.files):
+            fuse_op.lookup(inode_dir, _name(index))
+    with measure('getattr', scale.files):
+        for inode in list_inodes:
+            fuse_op.getattr(inode)
+    fuse_op.forget([(inode, 2) for inode in list_inodes])
+    with measure('readdir', scale.files):
+        fh = fuse_op.opendir(inode_dir)
+        entries = sum(1 for _ in fuse_op.readdir(fh, 0))
+        fuse_op.releasedir(fh)
+    assert entries >= scale.files
+    volume.unmount(fuse_op)
+
+
+def churn(volume, scale, measure):
+    '''rename and unlink of many small files'''
+    fuse_op = volume.mount()
+    inode_dir = _mkdir(fuse_op, b'churn')
+    list_inodes = []
+    for index in range(scale.files):
+        fh, inode = _create(fuse_op, inode_dir, _name(index))
+        fuse_op.write(fh, 0, b'x' * scale.small_size)
+        _close(fuse_op, fh)
+        list_inodes.append(inode)
+    for inode in list_inodes:
+        assert fuse_op.getattr(inode).st_size == scale.small_size
+    with measure('rename', scale.files):
+        for index in range(scale.files):
+            fuse_op.rename(
+                inode_dir, _name(index), inode_dir, _name(index) + b'.r')
+    with measure('unlink', scale.files):
+        for index, inode in enumerate(list_inodes):
+            fuse_op.unlink(inode_dir, _name(index) + b'.r')
+            # kernel forgets the inode once it is unlinked
+            fuse_op.forget([(inode, 1)])
+    volume.unmount(fuse_op)
+
+
+def sequential(volume, scale, measure):
+    '''sequential write, fsync, and sequential read of one large file'''
+    fuse_op = volume.mount()
+    fh, inode = _create(fuse_op, 1, b'sequential')
+    buf = os.urandom(scale.io_size)
+    ops = scale.size // scale.io_size
+    with measure('sequential_write', ops, ops * scale.io_size):
+        for index in range(ops):
+            fuse_op.write(fh, index * scale.io_size, buf)
+        fuse_op.fsync(fh, False)
+    _close(fuse_op, fh)
+    fh = fuse_op.open(inode, OPEN_FLAGS)
+    with measure('sequential_read', ops, ops * scale.io_size):
+        for index in range(ops):
+            fuse_op.read(fh, index * scale.io_size, scale.io_size)
+    _close(fuse_op, fh)
+    fuse_op.forget([(inode, 1)])
+    volume.unmount(fuse_op)
+
+
+def random_io(volume, scale, measure):
+    '''random small writes and reads within one large file'''
+    fuse_op = volume.mount()
+    fh, inode = _create(fuse_op, 1, b'random')
+    buf = os.urandom(scale.random_size)
+    fuse_op.write(fh, scale.size - len(buf), buf)
+    fuse_op.fsync(fh, False)
+    generator = random.Random(0)
+    list_offsets = [
+        generator.randrange(scale.size // scale.random_size) *
+        scale.random_size for _ in range(scale.random_ops)]
+    with measure('random_write', scale.random_ops,
+                 scale.random_ops * scale.random_size):
+        for offset in list_offsets:
+            fuse_op.write(fh, offset, buf)
+        fuse_op.fsync(fh, False)
+    generator.shuffle(list_offsets)
+    with measure('random_read', scale.random_ops,
+                 scale.random_ops * scale.random_size):
+        for offset in list_offsets:
+            fuse_op.read(fh, offset, scale.random_size)
+    _close(fuse_op, fh)
+    fuse_op.forget([(inode, 1)])
+    volume.unmount(fuse_op)
+
+
+def remount(volume, scale, measure):
+    '''unmount and mount with metadata of many inodes'''
+    fuse_op = volume.mount()
+    inode_dir = _mkdir(fuse_op, b'remount')
+    for index in range(scale.files):
+        fuse_op.mknod(inode_dir, _name(index), FILE_MODE, 0, Context())
+    with measure('unmount', 1):
+        volume.unmount(fuse_op)
+    with measure('mount', 1):
+        fuse_op = volume.mount()
+    volume.unmount(fuse_op)
+
+
+CASES = OrderedDict((
+    ('metadata', metadata),
+    ('churn', churn),
+    ('sequential', sequential),
+    ('random', random_io),
+    ('remount', remount),
+))
@@ -0,0 +1,299 @@
+'''
+PCSServer
+Local stand-in of the PCS file API used by remote/bpan.py, files are kept
+in memory, with injectable latency, bandwidth caps and error rate so WAN
+conditions can be reproduced on one machine, e.g.
+python3 -m benchmark.pcsserver --latency 0.05 --download-bandwidth 4194304
+mount.cpfs -o base_url=http://127.0.0.1:8080 bpan://token/apps/cpfs ...
+'''
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import hashlib
+import json
+import random
+import time
+from threading import Lock, Thread
+from cpfs.compatibility import BaseHTTPRequestHandler, HTTPServer, \
+    ThreadingMixIn, parse_qsl, urlparse
+from cpfs.logger import logger
+
+# error_code of PCS
+PCS_FILE_NOT_EXIST = 31066
+PCS_FREQUENCY_LIMIT = 31034
+PCS_BLOCK_MISSING = 31363
+PCS_INVALID_PARAMETER = 31023
+# bytes sent or received between bandwidth checks
+CHUNK_SIZE = 1 << 16
+
+
+class Throttle:
+    '''Bandwidth cap shared by all connections in one direction'''
+    def __init__(self, bandwidth=0):
+        # bytes per second, 0 if not capped
+        self.bandwidth = bandwidth
+        # time the link is free again
+        self.available = 0
+        self.mutex = Lock()
+
+    def consume(self, size):
+        if not self.bandwidth:
+            return
+        with self.mutex:
+            now = time.time()
+            self.available = max(now, self.available) + size / self.bandwidth
+            delay = self.available - now
+        time.sleep(delay)
+
+
+def parse_multipart(content_type, body):
+    '''Return {name: value} of multipart/form-data body'''
+    boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+    dict_fields = {}
+    for part in body.split(b'--' + boundary)[1:]:
+        if part.startswith(b'--'):
+            break
+        headers, _, value = part.partition(b'\r\n\r\n')
+        for header in headers.decode().split('\r\n'):
+            if header.lower().startswith('content-disposition:'):
+                name = header.split('name="', 1)[1].split('"', 1)[0]
+                dict_fields[name] = value[:-2]
+    return dict_fields
+
+
+class PCSError(Exception):
+    def __init__(self, status, error_code, error_msg):
+        super(PCSError, self).__init__(error_msg)
+        self.status = status
+        self.error_code = error_code
+
+
+class PCSRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        list_chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, CHUNK_SIZE))
+            if not chunk:
+                break
+            self.server.upload_throttle.consume(len(chunk))
+            list_chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(list_chunks)
+
+    def _handle(self, method):
+        parsed_url = urlparse(self.path)
+        parameters = dict(parse_qsl(parsed_url.query))
+        body = self._body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            if random.random() < self.server.error_rate:
+                raise PCSError(
+                    503, PCS_FREQUENCY_LIMIT, 'hit frequency limit')
+            fields = {}
+            if body:
+                fields = parse_multipart(
+                    self.headers.get('Content-Type', ''), body)
+            handler = getattr(self.server, '_'.join((
+                parsed_url.path.rsplit('/', 1)[-1],
+                parameters.get('method', ''))), None)
+            if handler is None:
+                raise PCSError(
+                    400, PCS_INVALID_PARAMETER, 'unsupported method')
+            status, headers, result = handler(
+                method, parameters, fields, self.headers)
+        except PCSError as e:
+            status, headers, result = e.status, {}, {
+                'error_code': e.error_code, 'error_msg': str(e)}
+        if not isinstance(result, bytes):
+            result = json.dumps(dict(
+                result, request_id=random.getrandbits(63))).encode()
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(result)))
+        self.end_headers()
+        for offset in range(0, len(result), CHUNK_SIZE):
+            chunk = result[offset:offset + CHUNK_SIZE]
+            self.server.download_throttle.consume(len(chunk))
+            self.wfile.write(chunk)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, format, *args):
+        logger.debug('pcsserver: ' + format % args)
+
+
+class PCSServer(ThreadingMixIn, HTTPServer):
+    '''
+    Methods of file API: upload (whole file or tmpfile), createsuperfile,
+    download (with Range), meta, delete (one path or list), list, and
+    info of quota API
+    Every request waits latency seconds, and fails with error_rate
+    probability as if frequency limited, uploads and downloads share
+    bandwidth caps in bytes per second
+    '''
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0,
+                 upload_bandwidth=0, download_bandwidth=0, error_rate=0,
+                 quota=1 << 40):
+        HTTPServer.__init__(self, address, PCSRequestHandler)
+        self.latency = latency
+        self.upload_throttle = Throttle(upload_bandwidth)
+        self.download_throttle = Throttle(download_bandwidth)
+        self.error_rate = error_rate
+        self.quota = quota
+        # path -> content
+        self.dict_files = {}
+        # md5 -> content of uploaded tmpfile
+        self.dict_tmpfiles = {}
+        self.mutex = Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def _file(self, path):
+        if path not in self.dict_files:
+            raise PCSError(404, PCS_FILE_NOT_EXIST, 'file does not exist')
+        return self.dict_files[path]
+
+    @staticmethod
+    def _entry(path, data):
+        return {
+            'path': path, 'size': len(data), 'isdir': 0,
+            'md5': hashlib.md5(data).hexdigest()}
+
+    def start(self):
+        '''Serve in background'''
+        self.thread = Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def file_createsuperfile(self, method, parameters, fields, headers):
+        block_list = json.loads(fields['param'].decode())['block_list']
+        with self.mutex:
+            for md5 in block_list:
+                if md5 not in self.dict_tmpfiles:
+                    raise PCSError(
+                        400, PCS_BLOCK_MISSING, 'block {} missing'.format(md5))
+            data = b''.join(self.dict_tmpfiles[md5] for md5 in block_list)
+            self.dict_files[parameters['path']] = data
+        return 200, {}, self._entry(parameters['path'], data)
+
+    def file_delete(self, method, parameters, fields, headers):
+        if 'param' in fields:
+            list_paths = [entry['path'] for entry in json.loads(
+                fields['param'].decode())['list']]
+        else:
+            list_paths = [parameters['path']]
+        with self.mutex:
+            missing = [
+                path for path in list_paths
+                if self.dict_files.pop(path, None) is None]
+        if missing:
+            raise PCSError(404, PCS_FILE_NOT_EXIST, 'file does not exist')
+        return 200, {}, {}
+
+    def file_download(self, method, parameters, fields, headers):
+        with self.mutex:
+            data = self._file(parameters['path'])
+        range_header = headers.get('Range')
+        if not range_header:
+            return 200, {}, data
+        start, end = range_header.split('=', 1)[1].split('-', 1)
+        start = int(start)
+        end = min(int(end or len(data) - 1), len(data) - 1)
+        if start >= len(data):
+            raise PCSError(416, PCS_INVALID_PARAMETER, 'range not satisfied')
+        return 206, {
+            'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))
+        }, data[start:end + 1]
+
+    def file_list(self, method, parameters, fields, headers):
+        prefix = parameters['path'].rstrip('/') + '/'
+        with self.mutex:
+            list_entries = [
+                self._entry(path, data)
+                for path, data in self.dict_files.items()
+                if path.startswith(prefix) and '/' not in path[len(prefix):]]
+        if not list_entries:
+            raise PCSError(404, PCS_FILE_NOT_EXIST, 'file does not exist')
+        list_entries.sort(key=lambda entry: entry['path'])
+        if 'limit' in parameters:
+            start, end = parameters['limit'].split('-', 1)
+            list_entries = list_entries[int(start):int(end)]
+        return 200, {}, {'list': list_entries}
+
+    def file_meta(self, method, parameters, fields, headers):
+        with self.mutex:
+            data = self._file(parameters['path'])
+        return 200, {}, {'list': [self._entry(parameters['path'], data)]}
+
+    def file_upload(self, method, parameters, fields, headers):
+        data = fields.get('file', b'')
+        if parameters.get('type') == 'tmpfile':
+            md5 = hashlib.md5(data).hexdigest()
+            with self.mutex:
+                self.dict_tmpfiles[md5] = data
+            return 200, {}, {'md5': md5}
+        with self.mutex:
+            self.dict_files[parameters['path']] = data
+        return 200, {}, self._entry(parameters['path'], data)
+
+    def quota_info(self, method, parameters, fields, headers):
+        with self.mutex:
+            used = sum(len(data) for data in self.dict_files.values())
+        return 200, {}, {'quota': self.quota, 'used': used}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m benchmark.pcsserver',
+        description='Serve a local stand-in of the PCS file API.')
+    parser.add_argument(
+        '--host', default='127.0.0.1', help='(default: %(default)s)')
+    parser.add_argument(
+        '-p', '--port', type=int, default=8080, help='(default: %(default)s)')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds every request waits (default: %(default)s)')
+    parser.add_argument(
+        '--upload-bandwidth', type=int, default=0,
+        help='bytes per second of uploads, 0 if not capped')
+    parser.add_argument(
+        '--download-bandwidth', type=int, default=0,
+        help='bytes per second of downloads, 0 if not capped')
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='probability a request fails (default: %(default)s)')
+    args = parser.parse_args()
+
+    server = PCSServer(
+        (args.host, args.port), args.latency, args.upload_bandwidth,
+        args.download_bandwidth, args.error_rate)
+    print('serving on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Volume
+Freshly formatted backend, mounted as FuseOperations without the kernel
+'''
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+from cpfs.compatibility import load_source
+from cpfs.metadata import TmpMetadataConnection, METADATA_STORAGE_NAME, \
+    METADATA_JOURNAL_NAME, save_metadata
+from cpfs.mkfs import init_metadata_db
+from cpfs.storage import init_storage_operations
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def load_fuse_operations():
+    return load_source(
+        'mount_cpfs', os.path.join(ROOT_PATH, 'mount.cpfs')).FuseOperations
+
+
+class Context:
+    '''Stand-in of llfuse.RequestContext'''
+    def __init__(self, uid=0, gid=0, pid=0, umask=0o022):
+        self.uid = uid
+        self.gid = gid
+        self.pid = pid
+        self.umask = umask
+
+
+class Volume:
+    def __init__(self, backend, mount_arguments='', hostname='',
+                 **options):
+        '''
+        backend: 'local', 'memory', or 'bpan' with base_url of a stand-in
+            server in mount_arguments
+        hostname: hostname part of url, access_token of bpan
+        options: keyword arguments of FuseOperations
+        '''
+        self.backend = backend
+        self.hostname = hostname
+        self.mount_arguments = mount_arguments
+        self.options = options
+        self.options.setdefault('blksize', 1 << 20)
+        self.FuseOperations = load_fuse_operations()
+        self.path = tempfile.mkdtemp(prefix='cpfs-benchmark-')
+        self.storage_op = None
+        storage_op = self._storage_op()
+        metadata_conn = TmpMetadataConnection()
+        init_metadata_db(metadata_conn)
+        for name in (METADATA_STORAGE_NAME, METADATA_JOURNAL_NAME):
+            storage_op.create(name)
+        save_metadata(storage_op, metadata_conn)
+        metadata_conn.close()
+        if backend != 'memory':
+            storage_op.destory()
+
+    def _storage_op(self):
+        # memory backend keeps objects only as long as its instance
+        if self.backend == 'memory' and self.storage_op:
+            return self.storage_op
+        self.storage_op = init_storage_operations(
+            '{}://{}{}'.format(self.backend, self.hostname, self.path),
+            self.mount_arguments)
+        return self.storage_op
+
+    def close(self):
+        shutil.rmtree(self.path, True)
+
+    def mount(self):
+        return self.FuseOperations(self._storage_op(), **self.options)
+
+    def unmount(self, fuse_op):
+        fuse_op.destroy()
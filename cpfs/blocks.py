@@ -0,0 +1,492 @@
+'''
+BlockStorageOperations
+Store each regular file as one object per block, so only touched blocks
+are read, written, uploaded and removed
+'''
+from __future__ import absolute_import
+
+import hashlib
+from threading import Lock, RLock
+from .compatibility import blob_type, getargspec
+
+# object name of content-addressed block
+CHUNK_NAME_PREFIX = 'c'
+# partly written blocks buffered per file, all are stored beyond
+BUFFERED_BLOCKS_MAX = 16
+# record inode changed since last fsck, checked by incremental fsck
+SQL_MARK_DIRTY = "INSERT OR IGNORE INTO dirty_inodes (inode) VALUES (?)"
+
+
+class BlockAttr:
+    '''Stand-in of EntryAttributes for StorageOperations.open'''
+    def __init__(self, st_size):
+        self.st_size = st_size
+
+
+class BlockFile:
+    def __init__(self, inode, blksize, length, blocks, hashes):
+        self.inode = inode
+        self.blksize = blksize
+        self.length = length
+        # block -> size of block object
+        self.blocks = blocks
+        # block -> hash of content-addressed block object
+        self.hashes = hashes
+        # blocks stored as '<inode>.<block>' objects
+        self.objects = set(blocks) - set(hashes)
+        # block -> content not stored yet, dedup mode only
+        self.buffers = {}
+        # blocks whose size is not saved yet
+        self.dirty_blocks = set()
+        self.opened_names = set()
+        # chunks stored since last sync
+        self.unsynced_names = set()
+        # content kept in metadata, None if stored in blocks
+        self.inline = None
+        self.inline_dirty = False
+        # inode recorded in dirty_inodes, stays until next fsck
+        self.marked = False
+        self.mutex = RLock()
+
+    def name(self, block):
+        if self.hashes.get(block):
+            return CHUNK_NAME_PREFIX + self.hashes[block]
+        return '{}.{}'.format(self.inode, block)
+
+
+class BlockStorageOperations:
+    '''
+    Wrap StorageOperations of a backend
+    Files without a layout are whole objects written before block layout,
+    and are passed through
+    In dedup mode blocks are buffered while written, and stored by content
+    hash with a reference count once completely written, or on flush
+    Files up to inline_threshold bytes are kept in metadata instead of
+    blocks, moved to blocks once they grow beyond, and back once truncated
+    '''
+    def __init__(self, storage_op, conn, blksize, dedup=False,
+                 inline_threshold=0):
+        self.storage_op = storage_op
+        self.conn = conn
+        self.blksize = blksize
+        self.dedup = dedup
+        self.inline_threshold = inline_threshold
+        self.dict_files = {}
+        self.mutex_chunks = Lock()
+        # name -> files holding object opened, chunks are shared by files
+        self.dict_opened = {}
+        self.mutex_opened = Lock()
+        self.open_with_attr = 'attr' in getargspec(storage_op.open).args
+        # backends without sync are as durable as after flush
+        self.sync_object = getattr(storage_op, 'sync', storage_op.flush)
+
+    def _block_file(self, inode, blksize, attr=None):
+        blocks = {}
+        hashes = {}
+        for block, size, hash_ in self.conn.read_execute(
+                "SELECT block, size, hash FROM blocks WHERE inode = ?",
+                (inode,)):
+            blocks[block] = size
+            if hash_:
+                hashes[block] = hash_
+        inline = self.conn.read_execute(
+            "SELECT data FROM inline WHERE inode = ?", (inode,)).fetchone()
+        if inline:
+            block_file = BlockFile(
+                inode, blksize, len(inline[0]), blocks, hashes)
+            block_file.inline = bytearray(inline[0])
+            return block_file
+        if attr:
+            length = attr.st_size
+        else:
+            length = max(
+                [block * blksize + size for block, size in blocks.items()] +
+                [0])
+        return BlockFile(inode, blksize, length, blocks, hashes)
+
+    def _buffer(self, block_file, block):
+        '''Load block into memory for writing'''
+        if block not in block_file.buffers:
+            buf = bytearray()
+            if block in block_file.hashes or block in block_file.objects:
+                buf += self.storage_op.read(
+                    self._open_block(block_file, block), 0,
+                    block_file.blocks[block])
+            block_file.buffers[block] = buf
+        return block_file.buffers[block]
+
+    def _acquire(self, name, size):
+        '''Open object in backend on first open by any file'''
+        with self.mutex_opened:
+            if name not in self.dict_opened:
+                self._open(name, BlockAttr(size))
+                self.dict_opened[name] = 0
+            self.dict_opened[name] += 1
+
+    def _close_block(self, block_file, block):
+        name = block_file.name(block)
+        if name in block_file.opened_names:
+            self._release(name)
+            block_file.opened_names.discard(name)
+
+    def _decref(self, hash_):
+        '''Return name of chunk if removed now'''
+        with self.mutex_chunks:
+            self.conn.write_execute(
+                "UPDATE chunks SET refcount = refcount - 1 WHERE hash = ?",
+                (hash_,))
+            refcount, size = next(self.conn.read_execute(
+                "SELECT refcount, size FROM chunks WHERE hash = ?",
+                (hash_,)))
+            if refcount < 1:
+                name = CHUNK_NAME_PREFIX + hash_
+                # backends may only remove opened objects
+                with self.mutex_opened:
+                    if self.dict_opened.pop(name, None) is None:
+                        self._open(name, BlockAttr(size))
+                self.storage_op.remove(name)
+                self.conn.write_execute(
+                    "DELETE FROM chunks WHERE hash = ?", (hash_,))
+                return name
+            return None
+
+    def _incref(self, hash_, data):
+        '''Return name of chunk if stored now'''
+        with self.mutex_chunks:
+            if self.conn.read_execute(
+                    "SELECT refcount FROM chunks WHERE hash = ?",
+                    (hash_,)).fetchone():
+                self.conn.write_execute(
+                    "UPDATE chunks SET refcount = refcount + 1 "
+                    "WHERE hash = ?", (hash_,))
+                return None
+            name = CHUNK_NAME_PREFIX + hash_
+            self.storage_op.create(name)
+            self._open(name, BlockAttr(0))
+            self.storage_op.write(name, 0, data)
+            self.storage_op.flush(name)
+            self.storage_op.close(name)
+            self.conn.write_execute(
+                "INSERT INTO chunks (hash, size, refcount) VALUES (?, ?, 1)",
+                (hash_, len(data)))
+            return name
+
+    def _inline(self, block_file):
+        '''Move content of blocks into metadata'''
+        self._mark_dirty(block_file)
+        data = self.read(str(block_file.inode), 0, block_file.length)
+        for block in list(block_file.blocks):
+            self._remove_block(block_file, block)
+        block_file.inline = bytearray(data)
+        self.conn.write_execute(
+            "INSERT OR REPLACE INTO inline (inode, data) VALUES (?, ?)",
+            (block_file.inode, blob_type(data)))
+
+    def _layout(self, inode):
+        layout = self.conn.read_execute(
+            "SELECT blksize FROM layouts WHERE inode = ?", (inode,)
+        ).fetchone()
+        return layout and layout[0]
+
+    def _mark_dirty(self, block_file):
+        '''Blocks, chunks or inline content of inode are about to change'''
+        if not block_file.marked:
+            self.conn.write_execute(SQL_MARK_DIRTY, (block_file.inode,))
+            block_file.marked = True
+
+    def _open(self, name, attr=None):
+        if self.open_with_attr:
+            self.storage_op.open(name, attr)
+        else:
+            self.storage_op.open(name)
+
+    def _open_block(self, block_file, block):
+        name = block_file.name(block)
+        if name not in block_file.opened_names:
+            self._acquire(name, block_file.blocks[block])
+            block_file.opened_names.add(name)
+        return name
+
+    def _release(self, name):
+        '''Close object in backend on last close by any file'''
+        with self.mutex_opened:
+            self.dict_opened[name] -= 1
+            if self.dict_opened[name]:
+                return
+            del self.dict_opened[name]
+            self.storage_op.close(name)
+
+    def _release_block(self, block_file, block):
+        '''Drop block object, leave block table to caller'''
+        self._close_block(block_file, block)
+        hash_ = block_file.hashes.pop(block, None)
+        if hash_:
+            # removed chunk has nothing left to sync
+            block_file.unsynced_names.discard(self._decref(hash_))
+        elif block in block_file.objects:
+            # backends may only remove opened objects
+            name = self._open_block(block_file, block)
+            with self.mutex_opened:
+                del self.dict_opened[name]
+            self.storage_op.remove(name)
+            block_file.opened_names.discard(name)
+            block_file.objects.discard(block)
+
+    def _remove_block(self, block_file, block):
+        self._mark_dirty(block_file)
+        self._release_block(block_file, block)
+        block_file.buffers.pop(block, None)
+        block_file.dirty_blocks.discard(block)
+        del block_file.blocks[block]
+        self.conn.write_execute(
+            "DELETE FROM blocks WHERE inode = ? AND block = ?",
+            (block_file.inode, block))
+
+    def _outline(self, block_file):
+        '''Move content in metadata into blocks'''
+        self._mark_dirty(block_file)
+        data = bytes(block_file.inline)
+        block_file.inline = None
+        block_file.inline_dirty = False
+        block_file.length = 0
+        self.conn.write_execute(
+            "DELETE FROM inline WHERE inode = ?", (block_file.inode,))
+        if data:
+            self.write(str(block_file.inode), 0, data)
+
+    def _save_inline(self, block_file):
+        if block_file.inline_dirty:
+            self._mark_dirty(block_file)
+            self.conn.write_execute(
+                "UPDATE inline SET data = ? WHERE inode = ?",
+                (blob_type(bytes(block_file.inline)), block_file.inode))
+            block_file.inline_dirty = False
+
+    def _save_sizes(self, block_file):
+        if block_file.dirty_blocks:
+            self._mark_dirty(block_file)
+            self.conn.write_executemany(
+                "UPDATE blocks SET size = ? WHERE inode = ? AND block = ?",
+                [
+                    (block_file.blocks[block], block_file.inode, block)
+                    for block in block_file.dirty_blocks])
+            block_file.dirty_blocks.clear()
+
+    def _store_block(self, block_file, block):
+        '''Store buffered block by content hash'''
+        data = bytes(block_file.buffers.pop(block))
+        hash_ = hashlib.sha256(data).hexdigest()
+        if hash_ == block_file.hashes.get(block):
+            return
+        self._mark_dirty(block_file)
+        chunk_name = self._incref(hash_, data)
+        if chunk_name:
+            block_file.unsynced_names.add(chunk_name)
+        self._release_block(block_file, block)
+        block_file.hashes[block] = hash_
+        self.conn.write_execute(
+            "UPDATE blocks SET hash = ? WHERE inode = ? AND block = ?",
+            (hash_, block_file.inode, block))
+
+    def _store_buffers(self, block_file):
+        for block in list(block_file.buffers):
+            self._store_block(block_file, block)
+
+    def close(self, name):
+        block_file = self.dict_files.pop(name, None)
+        if block_file is None:
+            return self.storage_op.close(name)
+        with block_file.mutex:
+            self._save_inline(block_file)
+            self._store_buffers(block_file)
+            self._save_sizes(block_file)
+            for opened_name in block_file.opened_names:
+                self._release(opened_name)
+            block_file.opened_names.clear()
+
+    def create(self, name):
+        self.conn.write_execute(
+            "INSERT OR REPLACE INTO layouts (inode, blksize) VALUES (?, ?)",
+            (int(name), self.blksize))
+        if self.inline_threshold:
+            self.conn.write_execute(
+                "INSERT OR REPLACE INTO inline (inode, data) VALUES (?, ?)",
+                (int(name), blob_type(b'')))
+
+    def destory(self):
+        self.storage_op.destory()
+
+    def flush(self, name):
+        block_file = self.dict_files.get(name)
+        if block_file is None:
+            return self.storage_op.flush(name)
+        with block_file.mutex:
+            self._save_inline(block_file)
+            self._store_buffers(block_file)
+            for opened_name in block_file.opened_names:
+                self.storage_op.flush(opened_name)
+            self._save_sizes(block_file)
+
+    def open(self, name, attr=None):
+        inode = int(name)
+        blksize = self._layout(inode)
+        if not blksize:
+            return self._open(name, attr)
+        self.dict_files[name] = self._block_file(inode, blksize, attr)
+
+    def read(self, name, offset, length):
+        block_file = self.dict_files.get(name)
+        if block_file is None:
+            return self.storage_op.read(name, offset, length)
+        with block_file.mutex:
+            if block_file.inline is not None:
+                return bytes(block_file.inline[offset:offset + length])
+        end = min(offset + length, block_file.length)
+        list_chunks = []
+        while offset < end:
+            block, block_offset = divmod(offset, block_file.blksize)
+            chunk_length = min(end - offset, block_file.blksize - block_offset)
+            chunk = b''
+            with block_file.mutex:
+                buf = block_file.buffers.get(block)
+                if buf is not None:
+                    chunk = bytes(
+                        buf[block_offset:block_offset + chunk_length])
+                block_name = buf is None and block in block_file.blocks and \
+                    self._open_block(block_file, block)
+            if block_name:
+                chunk = self.storage_op.read(
+                    block_name, block_offset, chunk_length)
+            # hole, or block object shorter than block
+            list_chunks.append(chunk + b'\0' * (chunk_length - len(chunk)))
+            offset += chunk_length
+        return b''.join(list_chunks)
+
+    def remove(self, name):
+        inode = int(name)
+        blksize = self._layout(inode)
+        if not blksize:
+            return self.storage_op.remove(name)
+        block_file = self.dict_files.pop(name, None) or \
+            self._block_file(inode, blksize)
+        with block_file.mutex:
+            for block in list(block_file.blocks):
+                self._remove_block(block_file, block)
+        self.conn.write_execute(
+            "DELETE FROM inline WHERE inode = ?", (inode,))
+        self.conn.write_execute(
+            "DELETE FROM layouts WHERE inode = ?", (inode,))
+
+    def size(self, name):
+        block_file = self.dict_files.get(name)
+        if block_file is None:
+            return self.storage_op.size(name)
+        return block_file.length
+
+    def statfs(self):
+        return self.storage_op.statfs()
+
+    def sync(self, name):
+        '''Flush name, and block until its objects are durable'''
+        block_file = self.dict_files.get(name)
+        if block_file is None:
+            return self.sync_object(name)
+        with block_file.mutex:
+            self.flush(name)
+            set_names = block_file.opened_names | block_file.unsynced_names
+        for object_name in set_names:
+            self.sync_object(object_name)
+        with block_file.mutex:
+            block_file.unsynced_names -= set_names
+
+    def truncate(self, name, length):
+        block_file = self.dict_files.get(name)
+        if block_file is None:
+            return self.storage_op.truncate(name, length)
+        with block_file.mutex:
+            if block_file.inline is not None:
+                if length <= self.inline_threshold:
+                    del block_file.inline[length:]
+                    block_file.inline += b'\0' * (
+                        length - len(block_file.inline))
+                    block_file.inline_dirty = True
+                    block_file.length = length
+                    return length
+                self._outline(block_file)
+            elif length <= self.inline_threshold < block_file.length:
+                block_file.length = length
+                self._inline(block_file)
+                return length
+            last_block, last_size = divmod(length, block_file.blksize)
+            for block in list(block_file.blocks):
+                if block > last_block or \
+                        block == last_block and not last_size:
+                    self._remove_block(block_file, block)
+            if block_file.blocks.get(last_block, 0) > last_size:
+                if self.dedup or last_block in block_file.hashes:
+                    del self._buffer(block_file, last_block)[last_size:]
+                else:
+                    self.storage_op.truncate(
+                        self._open_block(block_file, last_block), last_size)
+                block_file.blocks[last_block] = last_size
+                block_file.dirty_blocks.add(last_block)
+            block_file.length = length
+        return length
+
+    def write(self, name, offset, buf):
+        block_file = self.dict_files.get(name)
+        if block_file is None:
+            return self.storage_op.write(name, offset, buf)
+        with block_file.mutex:
+            if block_file.inline is not None:
+                if offset + len(buf) <= self.inline_threshold:
+                    inline = block_file.inline
+                    if len(inline) < offset:
+                        inline += b'\0' * (offset - len(inline))
+                    inline[offset:offset + len(buf)] = buf
+                    block_file.inline_dirty = True
+                    block_file.length = len(inline)
+                    return len(buf)
+                self._outline(block_file)
+        position = 0
+        while position < len(buf):
+            block, block_offset = divmod(
+                offset + position, block_file.blksize)
+            chunk_length = min(
+                len(buf) - position, block_file.blksize - block_offset)
+            chunk = buf[position:position + chunk_length]
+            with block_file.mutex:
+                if block not in block_file.blocks:
+                    self._mark_dirty(block_file)
+                    if not self.dedup:
+                        self.storage_op.create(block_file.name(block))
+                        block_file.objects.add(block)
+                    block_file.blocks[block] = 0
+                    self.conn.write_execute(
+                        "INSERT INTO blocks (inode, block, size) "
+                        "VALUES (?, ?, 0)", (block_file.inode, block))
+                if self.dedup or block in block_file.hashes:
+                    # content-addressed blocks are immutable
+                    block_buf = self._buffer(block_file, block)
+                    if len(block_buf) < block_offset:
+                        block_buf += b'\0' * (block_offset - len(block_buf))
+                    block_buf[block_offset:block_offset + chunk_length] = \
+                        chunk
+                    block_name = None
+                else:
+                    block_name = self._open_block(block_file, block)
+                if block_offset + chunk_length > block_file.blocks[block]:
+                    block_file.blocks[block] = block_offset + chunk_length
+                    block_file.dirty_blocks.add(block)
+                # keep memory bounded however large the file grows
+                if block_name is None:
+                    if len(block_buf) >= block_file.blksize:
+                        self._store_block(block_file, block)
+                    elif len(block_file.buffers) > BUFFERED_BLOCKS_MAX:
+                        self._store_buffers(block_file)
+            if block_name:
+                self.storage_op.write(block_name, block_offset, chunk)
+            position += chunk_length
+        with block_file.mutex:
+            block_file.length = max(block_file.length, offset + len(buf))
+        return len(buf)
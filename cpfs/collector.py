@@ -0,0 +1,143 @@
+'''
+CollectorStorageOperations
+Wrap StorageOperations of a backend, removed objects are recorded in
+metadata and deleted in background, in batches by parallel workers, so
+removing does not wait for the backend
+'''
+from __future__ import absolute_import
+
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Lock, Thread
+from .compatibility import getargspec
+from .logger import logger
+
+
+class CollectorStorageOperations:
+    '''
+    Backends may provide remove_many(names), removing objects whether
+    opened or not, otherwise each object is opened and removed
+    Recorded removals survive crashes and are retried until done
+    '''
+    def __init__(self, storage_op, conn, workers=4, batch=100, interval=5):
+        self.storage_op = storage_op
+        self.conn = conn
+        self.batch = batch
+        self.interval = interval
+        self.open_with_attr = 'attr' in getargspec(storage_op.open).args
+        self.pool = ThreadPool(workers)
+        self.workers = workers
+        # names being deleted
+        self.set_deleting = set()
+        self.closed = False
+        self.mutex = Lock()
+        self.changed = Condition(self.mutex)
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _delete(self, names):
+        '''Delete batch of recorded names, return whether done'''
+        try:
+            if hasattr(self.storage_op, 'remove_many'):
+                self.storage_op.remove_many(names)
+            else:
+                for name in names:
+                    self._open(name)
+                    self.storage_op.remove(name)
+        except Exception as e:
+            logger.warning('collector: delete {} objects failed: {}'.format(
+                len(names), e))
+            return False
+        self.conn.write_executemany(
+            "DELETE FROM deletions WHERE name = ?",
+            [(name,) for name in names])
+        return True
+
+    def _open(self, name, attr=None):
+        if self.open_with_attr:
+            self.storage_op.open(name, attr)
+        else:
+            self.storage_op.open(name)
+
+    def _run(self):
+        while True:
+            with self.mutex:
+                if self.closed:
+                    break
+                list_names = [name for name, in self.conn.read_execute(
+                    "SELECT name FROM deletions LIMIT ?",
+                    (self.batch * self.workers,)).fetchall()]
+                if not list_names:
+                    self.changed.wait(self.interval)
+                    continue
+                self.set_deleting.update(list_names)
+            try:
+                done = all(self.pool.map(self._delete, [
+                    list_names[index:index + self.batch]
+                    for index in range(0, len(list_names), self.batch)]))
+            finally:
+                with self.mutex:
+                    self.set_deleting.difference_update(list_names)
+                    self.changed.notify_all()
+            logger.debug('collector: deleted {} objects'.format(
+                len(list_names)))
+            if not done:
+                with self.mutex:
+                    if not self.closed:
+                        self.changed.wait(self.interval)
+
+    def close(self, name):
+        return self.storage_op.close(name)
+
+    def create(self, name):
+        with self.mutex:
+            # name removed before, delete old object first
+            while name in self.set_deleting:
+                self.changed.wait()
+            pending = self.conn.read_execute(
+                "SELECT name FROM deletions WHERE name = ?",
+                (name,)).fetchone()
+            if pending and not self._delete([name]):
+                raise IOError('collector: {} not deleted yet'.format(name))
+            return self.storage_op.create(name)
+
+    def destory(self):
+        self.stop()
+        self.pool.terminate()
+        self.storage_op.destory()
+
+    def flush(self, name):
+        return self.storage_op.flush(name)
+
+    def open(self, name, attr=None):
+        return self._open(name, attr)
+
+    def read(self, name, offset, length):
+        return self.storage_op.read(name, offset, length)
+
+    def remove(self, name):
+        # picked up within interval, along with others removed meanwhile
+        self.conn.write_execute(
+            "INSERT OR IGNORE INTO deletions (name) VALUES (?)", (name,))
+
+    def size(self, name):
+        return self.storage_op.size(name)
+
+    def statfs(self):
+        return self.storage_op.statfs()
+
+    def stop(self):
+        '''Stop deleting, recorded removals are left for next mount'''
+        with self.mutex:
+            self.closed = True
+            self.changed.notify_all()
+        self.thread.join()
+
+    def sync(self, name):
+        return getattr(self.storage_op, 'sync', self.storage_op.flush)(name)
+
+    def truncate(self, name, length):
+        return self.storage_op.truncate(name, length)
+
+    def write(self, name, offset, buf):
+        return self.storage_op.write(name, offset, buf)
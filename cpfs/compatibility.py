@@ -1,3 +1,5 @@
+import sys
+
 if bytes == str:
     PY2 = True
     blob_type = buffer
@@ -11,6 +13,13 @@ if bytes == str:
     from urllib2 import Request
     from urllib2 import urlopen
     from urllib2 import HTTPError
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib import pathname2url
+    from inspect import getargspec
+    from urlparse import parse_qsl
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from imp import load_source
 else:
     PY2 = False
     blob_type = bytes
@@ -24,3 +33,19 @@ else:
     from urllib.request import Request
     from urllib.request import urlopen
     from urllib.error import HTTPError
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.request import pathname2url
+    from inspect import getfullargspec as getargspec
+    from urllib.parse import parse_qsl
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+
+    def load_source(name, pathname):
+        '''imp.load_source, imp is gone since Python 3.12'''
+        loader = SourceFileLoader(name, pathname)
+        module = module_from_spec(spec_from_loader(name, loader))
+        loader.exec_module(module)
+        sys.modules[name] = module
+        return module
@@ -0,0 +1,143 @@
+'''
+ConnectionPool
+Keep-alive HTTP connections shared between threads, one pool per host
+'''
+from __future__ import absolute_import
+
+import select
+import socket
+import time
+from threading import BoundedSemaphore, Lock
+from .compatibility import HTTPConnection, HTTPSConnection, HTTPException, \
+    urlparse
+from .logger import logger
+
+# responses worth retrying
+TRANSIENT_STATUSES = frozenset((429, 500, 502, 503, 504))
+# responses to requests the server did not process, retried even if not
+# idempotent
+REJECTED_STATUSES = frozenset((429, 503))
+# methods safe to send again after the server may have processed them
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+
+
+def _dropped(connection):
+    '''Whether idle connection is closed by server'''
+    if connection.sock is None:
+        return False
+    # idle connection is readable only on EOF or error
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, ValueError):
+        return True
+
+
+class ConnectionPool:
+    def __init__(self, size=8, idle_timeout=60, retries=3, backoff=0.5,
+                 timeout=60):
+        # connections per host
+        self.size = size
+        # seconds an idle connection is kept
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        # seconds before first retry, doubled for each retry
+        self.backoff = backoff
+        self.timeout = timeout
+        # (scheme, netloc) -> [(connection, time last used)]
+        self.dict_idle = {}
+        # (scheme, netloc) -> semaphore of connections in use
+        self.dict_slots = {}
+        self.mutex = Lock()
+
+    def _acquire(self, host):
+        '''Return (connection, whether reused)'''
+        with self.mutex:
+            if host not in self.dict_slots:
+                self.dict_slots[host] = BoundedSemaphore(self.size)
+                self.dict_idle[host] = []
+            slots = self.dict_slots[host]
+        slots.acquire()
+        with self.mutex:
+            list_idle = self.dict_idle[host]
+            while list_idle:
+                connection, last_used = list_idle.pop()
+                if time.time() - last_used < self.idle_timeout and \
+                        not _dropped(connection):
+                    return connection, True
+                connection.close()
+        scheme, netloc = host
+        return (scheme == 'https' and HTTPSConnection or HTTPConnection)(
+            netloc, timeout=self.timeout), False
+
+    def _release(self, host, connection=None):
+        '''Keep connection for reuse unless None'''
+        if connection is not None:
+            with self.mutex:
+                self.dict_idle[host].append((connection, time.time()))
+        self.dict_slots[host].release()
+
+    def close(self):
+        with self.mutex:
+            for list_idle in self.dict_idle.values():
+                for connection, _ in list_idle:
+                    connection.close()
+                del list_idle[:]
+
+    def request(self, method, url, body=None, headers=None,
+                idempotent=None):
+        '''
+        Return (status, body, headers) of response, header names in lower
+        case
+        Requests not idempotent (by method unless given) are retried only
+        if they did not reach the server, or were rejected by it
+        '''
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        parsed_url = urlparse(url)
+        host = (parsed_url.scheme, parsed_url.netloc)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path = '?'.join((path, parsed_url.query))
+        attempt = 0
+        while True:
+            connection, reused = self._acquire(host)
+            # slot is released whatever happens, connection kept only if
+            # response is read completely
+            kept = None
+            sent = False
+            try:
+                # streamed body is sent again from its beginning
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                connection.request(method, path, body, headers or {})
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+                if not response.will_close:
+                    kept = connection
+            except (socket.error, HTTPException) as e:
+                # may have been processed before connection failed
+                if sent and not idempotent:
+                    raise
+                # closed by server while idle, not counted as an attempt
+                if reused:
+                    continue
+                if attempt >= self.retries:
+                    raise
+                error = e
+            else:
+                if response.status not in (
+                        idempotent and TRANSIENT_STATUSES or
+                        REJECTED_STATUSES) or attempt >= self.retries:
+                    return response.status, data, dict(
+                        (key.lower(), value)
+                        for key, value in response.getheaders())
+                error = response.status
+            finally:
+                if kept is None:
+                    connection.close()
+                self._release(host, kept)
+            logger.debug('connectionpool: {} {} failed ({}), retry {}'.format(
+                method, parsed_url.path, error, attempt + 1))
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
@@ -0,0 +1,124 @@
+'''
+Container
+Chunked compressed object, (de)compressed in parallel and streamed through
+ranged storage reads and writes
+'''
+from __future__ import absolute_import
+
+import os
+import struct
+import zlib
+from collections import deque
+from itertools import chain
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+CONTAINER_MAGIC = b'CPFSZ\x00\x01\x00'
+# header: magic, generation stamp
+CONTAINER_HEADER = struct.Struct('>8sQ')
+# frame: length of compressed chunk
+CONTAINER_FRAME_HEADER = struct.Struct('>I')
+CHUNK_SIZE = 1 << 22
+
+
+def _bounded_imap(pool, func, iterable, window):
+    '''Ordered pool.imap with at most `window` chunks in flight'''
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _compress_frame(chunk):
+    compressed_chunk = zlib.compress(chunk)
+    return CONTAINER_FRAME_HEADER.pack(
+        len(compressed_chunk)) + compressed_chunk
+
+
+def _read_frames(storage_op, name, offset):
+    header_size = CONTAINER_FRAME_HEADER.size
+    header = storage_op.read(name, offset, header_size)
+    offset += header_size
+    while len(header) == header_size:
+        length, = CONTAINER_FRAME_HEADER.unpack(header)
+        # fetch next header together with this frame
+        data = storage_op.read(name, offset, length + header_size)
+        if len(data) < length:
+            raise ValueError("container '{}' truncated".format(name))
+        offset += length + header_size
+        header = data[length:]
+        yield data[:length]
+    if header:
+        raise ValueError("container '{}' truncated".format(name))
+
+
+def _read_legacy(storage_op, name, size, fh, chunk_size):
+    '''Objects written as a single zlib stream'''
+    decompressor = zlib.decompressobj()
+    for offset in range(0, size, chunk_size):
+        fh.write(decompressor.decompress(
+            storage_op.read(name, offset, chunk_size)))
+    fh.write(decompressor.flush())
+
+
+def _read_header(storage_op, name):
+    header = storage_op.read(name, 0, CONTAINER_HEADER.size)
+    if len(header) == CONTAINER_HEADER.size:
+        magic, stamp = CONTAINER_HEADER.unpack(header)
+        if magic == CONTAINER_MAGIC:
+            return stamp
+
+
+def read_container_stamp(storage_op, name):
+    '''(size, generation stamp), stamp is None for legacy objects'''
+    storage_op.open(name)
+    try:
+        return storage_op.size(name), _read_header(storage_op, name)
+    finally:
+        storage_op.close(name)
+
+
+def read_container(storage_op, name, fh, workers=None, chunk_size=CHUNK_SIZE):
+    workers = workers or cpu_count()
+    storage_op.open(name)
+    try:
+        size = storage_op.size(name)
+        if _read_header(storage_op, name) is None:
+            return _read_legacy(storage_op, name, size, fh, chunk_size)
+        pool = ThreadPool(workers)
+        try:
+            for chunk in _bounded_imap(
+                    pool, zlib.decompress,
+                    _read_frames(storage_op, name, CONTAINER_HEADER.size),
+                    workers * 2):
+                fh.write(chunk)
+        finally:
+            pool.terminate()
+    finally:
+        storage_op.close(name)
+
+
+def write_container(storage_op, name, fh, workers=None, chunk_size=CHUNK_SIZE):
+    '''Return (size, generation stamp) of written object'''
+    workers = workers or cpu_count()
+    stamp, = struct.unpack('>Q', os.urandom(8))
+    storage_op.open(name)
+    try:
+        pool = ThreadPool(workers)
+        try:
+            offset = 0
+            for frame in chain((CONTAINER_HEADER.pack(
+                    CONTAINER_MAGIC, stamp),), _bounded_imap(
+                    pool, _compress_frame,
+                    iter(lambda: fh.read(chunk_size), b''), workers * 2)):
+                offset += storage_op.write(name, offset, frame)
+        finally:
+            pool.terminate()
+        storage_op.truncate(name, offset)
+        storage_op.flush(name)
+    finally:
+        storage_op.close(name)
+    return offset, stamp
@@ -1,28 +1,360 @@
 '''
 FragmentCache
+Sparse cache of a remote object, fragments are kept in memory until the
+memory budget of FragmentCacheManager is used up, then clean fragments are
+evicted and dirty ones spilled to a sparse file on disk until uploaded
 '''
 from __future__ import absolute_import
 
-import bisect
-from threading import RLock
+import mmap
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Condition, Lock, RLock, Thread, local
 from .compatibility import BytesIO
+from .intervalset import IntervalSet
+
+# granularity of sparse file growth
+SPARSE_FILE_STEP = 1 << 20
+# gaps closer than this are fetched by one request, cached bytes between
+# them are discarded
+FETCH_MERGE_DISTANCE = 1 << 16
+# read-ahead window of sequential reads, doubled on each sequential read
+READ_AHEAD_MIN = 1 << 17
+READ_AHEAD_MAX = 1 << 23
+
+
+class ReadAhead:
+    '''Detect sequential reads and size the read-ahead window'''
+    def __init__(self):
+        self.next_offset = 0
+        self.window = 0
+
+    def access(self, offset, length):
+        '''Return read-ahead window, 0 for random reads'''
+        # tolerate reads reordered by concurrent requests
+        if abs(offset - self.next_offset) <= READ_AHEAD_MIN:
+            self.window = min(
+                max(self.window * 2, READ_AHEAD_MIN), READ_AHEAD_MAX)
+        else:
+            self.window = 0
+        self.next_offset = max(self.next_offset, offset + length) \
+            if self.window else offset + length
+        return self.window
+
+
+class SparseFile:
+    '''File-like object over mmap of a sparse temporary file'''
+    def __init__(self, cache_dir=None):
+        self.file = tempfile.TemporaryFile(dir=cache_dir)
+        self.map = None
+        self.capacity = 0
+        self.size = 0
+        self.position = 0
+
+    def _reserve(self, capacity):
+        if capacity == self.capacity:
+            return
+        if not capacity:
+            self.map.close()
+            self.map = None
+            self.file.truncate(0)
+        elif self.map is None:
+            self.file.truncate(capacity)
+            self.map = mmap.mmap(self.file.fileno(), capacity)
+        else:
+            # also truncates the file, space beyond size reads as zero
+            self.map.resize(capacity)
+        self.capacity = capacity
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def read(self, length=-1):
+        end = self.size if length < 0 else min(
+            self.position + length, self.size)
+        if self.map is None or end <= self.position:
+            return b''
+        buf = self.map[self.position:end]
+        self.position = end
+        return buf
+
+    def seek(self, offset, whence=0):
+        self.position = (0, self.position, self.size)[whence] + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self.position
+        if size < self.size:
+            self._reserve(size)
+        elif size > self.capacity:
+            self._reserve(size)
+        self.size = size
+        return size
+
+    def write(self, buf):
+        end = self.position + len(buf)
+        if end > self.capacity:
+            self._reserve(max(
+                -(-end // SPARSE_FILE_STEP) * SPARSE_FILE_STEP,
+                self.capacity + self.capacity // 2))
+        if buf:
+            self.map[self.position:end] = buf
+        self.position = end
+        self.size = max(self.size, end)
+        return len(buf)
+
+
+class FragmentCacheManager:
+    '''
+    Memory budget shared by FragmentCache of all files
+    Least recently used caches are shrunk first, caches in use by other
+    threads are skipped
+    '''
+    def __init__(self, memory_limit=1 << 28, cache_dir=None):
+        self.memory_limit = memory_limit
+        self.cache_dir = cache_dir
+        # cache -> bytes held in memory, least recently used first
+        self.caches = OrderedDict()
+        self.memory = 0
+        self.mutex = Lock()
+        self.local = local()
+
+    def _shrink(self, current, keep=None):
+        with self.mutex:
+            if self.memory <= self.memory_limit:
+                return
+            victims = list(self.caches)
+        self.local.shrinking = True
+        try:
+            for cache in victims:
+                if self.memory <= self.memory_limit:
+                    break
+                if cache.mutex.acquire(False):
+                    try:
+                        # range of current cache is about to be used
+                        cache.shrink(keep if cache is current else None)
+                    finally:
+                        cache.mutex.release()
+        finally:
+            self.local.shrinking = False
+
+    def forget(self, cache):
+        with self.mutex:
+            self.memory -= self.caches.pop(cache, 0)
+
+    def spill_file(self):
+        if self.cache_dir and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        return SparseFile(self.cache_dir)
+
+    def update(self, cache, touch=True, keep=None):
+        '''
+        Account memory of cache, shrink caches if over budget, except
+        range keep of cache
+        '''
+        memory = cache.memory_size()
+        with self.mutex:
+            if touch:
+                self.memory += memory - self.caches.pop(cache, 0)
+            else:
+                self.memory += memory - self.caches.get(cache, 0)
+            self.caches[cache] = memory
+        if touch and not getattr(self.local, 'shrinking', False):
+            self._shrink(cache, keep)
 
 
 class FragmentCache:
-    def __init__(self, factory):
+    '''
+    Fetches run without holding mutex, in-flight ranges are tracked so a
+    range is fetched once however many threads read it
+    '''
+    def __init__(self, factory, manager=None, length=0):
         if not callable(factory):
             raise TypeError('first argument must be callable')
         self.factory = factory
+        self.manager = manager
         self.stream = BytesIO()
-        self.cached_scope = [-1]
-        # odd: fragment beginning
-        # even: fragment ending
+        self.spilled = False
+        self.cached_scope = IntervalSet()
         self.dirty = False
-        self.length = 0
+        # ranges modified since remote object was last up to date
+        self.dirty_scope = IntervalSet()
+        self.dirty_bytes = 0
+        self.length = length
+        # size of remote object, content beyond is not fetched but zero
+        self.remote_length = length
+        self.read_ahead = ReadAhead()
+        self.prefetching = False
+        # (start offset, end offset) being fetched
+        self.fetching = []
+        # bumped when cache is dropped, truncated or remote content
+        # changes, fetched data of an older version is discarded
+        self.version = 0
+        # bumped by every modification, see snapshot
+        self.generation = 0
+        # latest generation the remote object is known to hold
+        self.synced_generation = 0
         self.mutex = RLock()
+        self.fetched = Condition(self.mutex)
 
     def __len__(self):
-        return max(0, self.cached_scope[-1], self.length)
+        return max(0, self.cached_scope.end() or 0, self.length)
+
+    def _fetch(self, offset, length):
+        fetch_length = max(0, min(length, self.remote_length - offset))
+        buf = fetch_length and self.factory(offset, fetch_length) or b''
+        return buf + b'\0' * (length - len(buf))
+
+    def _fill(self, start_offset, buf):
+        '''Write into gaps, fragments written meanwhile are kept'''
+        for gap_start, gap_end in self.cached_scope.gaps(
+                start_offset, start_offset + len(buf)):
+            self.stream.seek(gap_start)
+            self.stream.write(
+                buf[gap_start - start_offset:gap_end - start_offset])
+        self.cached_scope.add(start_offset, start_offset + len(buf))
+
+    def _prefetch(self, start_offset, end_offset):
+        if self.prefetching or start_offset >= end_offset or \
+                self.cached_scope.covers(start_offset, end_offset):
+            return
+        self.prefetching = True
+        thread = Thread(
+            target=self._prefetch_thread, args=(start_offset, end_offset))
+        thread.daemon = True
+        thread.start()
+
+    def _prefetch_thread(self, start_offset, end_offset):
+        try:
+            self.load(start_offset, end_offset)
+        finally:
+            self.prefetching = False
+
+    def _read_cached(self, offset, length):
+        '''None if not all cached'''
+        if not self.cached_scope.covers(offset, offset + length):
+            return None
+        self.stream.seek(offset)
+        buf = self.stream.read(length)
+        # truncated beyond end of stream
+        return buf + b'\0' * (length - len(buf))
+
+    def _update(self, keep=None):
+        if self.manager is not None:
+            self.manager.update(self, keep=keep)
+
+    def close(self):
+        '''Drop all fragments'''
+        with self.mutex:
+            self.stream.close()
+            self.stream = BytesIO()
+            self.spilled = False
+            self.cached_scope.clear()
+            self.read_ahead = ReadAhead()
+            self.version += 1
+            if self.manager is not None:
+                self.manager.forget(self)
+
+    def memory_size(self):
+        if self.spilled:
+            return 0
+        self.stream.seek(0, 2)
+        return self.stream.tell()
+
+    def set_clean(self, generation=None):
+        '''
+        Remote object is up to date with snapshot of generation, return
+        False if modified since
+        '''
+        with self.mutex:
+            if generation is None:
+                generation = self.generation
+            self.synced_generation = max(self.synced_generation, generation)
+            if generation != self.generation:
+                return False
+            self.dirty = False
+            self.dirty_scope.clear()
+            self.dirty_bytes = 0
+            self.remote_length = len(self)
+            self.version += 1
+            if self.spilled:
+                # spilled fragments are evicted, refetched when read
+                self.stream.close()
+                self.stream = BytesIO()
+                self.spilled = False
+                self.cached_scope.clear()
+            return True
+
+    def shrink(self, keep=None):
+        '''
+        Evict clean fragments except within range keep, or spill dirty
+        fragments to disk
+        '''
+        with self.mutex:
+            if self.spilled or not self.memory_size():
+                return
+            if not self.dirty:
+                stream = BytesIO()
+                cached_scope = IntervalSet()
+                keep_start, keep_end = keep or (0, 0)
+                for start_offset, end_offset in self.cached_scope:
+                    start_offset = max(start_offset, keep_start)
+                    end_offset = min(end_offset, keep_end)
+                    if start_offset < end_offset:
+                        self.stream.seek(start_offset)
+                        stream.seek(start_offset)
+                        stream.write(
+                            self.stream.read(end_offset - start_offset))
+                        cached_scope.add(start_offset, end_offset)
+                self.stream.close()
+                self.stream = stream
+                # fetches in flight still fill gaps with remote content
+                self.cached_scope = cached_scope
+            else:
+                stream = self.manager.spill_file()
+                for start_offset, end_offset in self.cached_scope:
+                    self.stream.seek(start_offset)
+                    stream.seek(start_offset)
+                    stream.write(self.stream.read(end_offset - start_offset))
+                stream.truncate(self.cached_scope.end() or 0)
+                self.stream.close()
+                self.stream = stream
+                self.spilled = True
+            self.manager.update(self, False)
+
+    def snapshot(self, offset=0, length=None):
+        '''
+        Return (content, generation), for upload without holding mutex
+        Content is consistent with generation of a snapshot of any part
+        '''
+        while True:
+            with self.mutex:
+                read_length = self._length_fix(
+                    offset, len(self) - offset if length is None else length)
+                buf = self._read_cached(offset, read_length) \
+                    if read_length else b''
+                if buf is not None:
+                    return buf, self.generation
+            self.load(offset, offset + read_length)
+
+    @staticmethod
+    def _plan(gaps):
+        '''Merge nearby gaps into one fetch'''
+        list_fetches = [gaps[0]]
+        for gap_start, gap_end in gaps[1:]:
+            if gap_start - list_fetches[-1][1] <= FETCH_MERGE_DISTANCE:
+                list_fetches[-1] = (list_fetches[-1][0], gap_end)
+            else:
+                list_fetches.append((gap_start, gap_end))
+        return list_fetches
 
     def _length_fix(self, offset, length):
         if offset > len(self):
@@ -32,65 +364,90 @@ class FragmentCache:
         return length
 
     def load(self, start_offset, end_offset, empty=False):
-        with self.mutex:
-            lower_index_plus_one = bisect.bisect_right(
-                self.cached_scope, start_offset)
-            upper_index = bisect.bisect_left(self.cached_scope, end_offset)
-            if not lower_index_plus_one & 1 and \
-                    lower_index_plus_one == upper_index:
-                return
-            if not empty:
-                scope_slice_index = zip(
-                    [start_offset] +
-                    self.cached_scope[lower_index_plus_one:upper_index] +
-                    [end_offset],
-                    range(lower_index_plus_one - 1, upper_index + 1))
-                current_slice_index = next(scope_slice_index)
-                try:
-                    while True:
-                        last_slice_index, current_slice_index = \
-                            current_slice_index, next(scope_slice_index)
-                        if current_slice_index[1] & 1:
-                            self.stream.seek(last_slice_index[0])
-                            self.stream.write(self.factory(
-                                last_slice_index[0],
-                                current_slice_index[0] - last_slice_index[0]))
-                except StopIteration:
-                    pass
-            del self.cached_scope[lower_index_plus_one:upper_index]
-            if lower_index_plus_one & 1:
-                self.cached_scope.insert(lower_index_plus_one, start_offset)
-            if upper_index & 1:
-                self.cached_scope.insert(
-                    lower_index_plus_one + 1, end_offset)
-            for check_index in (
-                    lower_index_plus_one, lower_index_plus_one + 2):
-                while check_index < len(self.cached_scope) and \
-                        self.cached_scope[check_index] == \
-                        self.cached_scope[check_index - 1]:
-                    del self.cached_scope[check_index], \
-                        self.cached_scope[check_index - 1]
+        if empty:
+            with self.mutex:
+                self.cached_scope.add(start_offset, end_offset)
+            return
+        while True:
+            with self.mutex:
+                end_offset = min(end_offset, len(self))
+                if start_offset >= end_offset or \
+                        self.cached_scope.covers(start_offset, end_offset):
+                    return
+                gaps = self.cached_scope.gaps(start_offset, end_offset)
+                for fetching_start, fetching_end in self.fetching:
+                    gaps = [
+                        gap for gap_start, gap_end in gaps for gap in (
+                            (gap_start, min(gap_end, fetching_start)),
+                            (max(gap_start, fetching_end), gap_end))
+                        if gap[0] < gap[1]]
+                if not gaps:
+                    # merge with fetches of other threads
+                    self.fetched.wait()
+                    continue
+                gaps = self._plan(gaps)
+                self.fetching.extend(gaps)
+                version = self.version
+            list_fetched = []
+            try:
+                for gap_start, gap_end in gaps:
+                    list_fetched.append((gap_start, self._fetch(
+                        gap_start, gap_end - gap_start)))
+            finally:
+                with self.mutex:
+                    for gap in gaps:
+                        self.fetching.remove(gap)
+                    if version == self.version:
+                        for gap_start, buf in list_fetched:
+                            self._fill(gap_start, buf)
+                    self.fetched.notify_all()
+            # fetched range is kept for the caller to read
+            self._update((start_offset, end_offset))
 
     def read(self, offset, length):
         with self.mutex:
             length = self._length_fix(offset, length)
             if not length:
                 return b''
-            if not self.dirty:
-                return self.factory(offset, length)
-            self.load(offset, offset + length)
-            self.stream.seek(offset)
-            return self.stream.read(length)
+            window = self.read_ahead.access(offset, length)
+        # missing fragment of sequential reads is fetched as a whole
+        # window, the window after cached fragment in background
+        load_length = max(length, window)
+        while True:
+            with self.mutex:
+                length = self._length_fix(offset, length)
+                if not length:
+                    return b''
+                buf = self._read_cached(offset, length)
+                if buf is not None:
+                    if window:
+                        cached_end = self.cached_scope.end(offset)
+                        if cached_end < offset + length + window:
+                            self._prefetch(cached_end, min(
+                                len(self), cached_end + window))
+                    break
+            self.load(offset, offset + load_length)
+        self._update()
+        return buf
 
     def truncate(self, length):
         with self.mutex:
+            if length > len(self):
+                self.dirty_scope.add(len(self), length)
+            self.dirty_scope.truncate(length)
+            self.dirty_bytes = sum(
+                end_offset - start_offset
+                for start_offset, end_offset in self.dirty_scope)
             self.stream.truncate(length)
-            index = bisect.bisect_left(self.cached_scope, length)
-            del self.cached_scope[index:]
-            if not index & 1:
-                self.cached_scope.append(length)
+            self.cached_scope.truncate(length)
             self.dirty = True
             self.length = length
+            # extended range is a hole, not remote content
+            self.remote_length = min(self.remote_length, length)
+            # fetches in flight may cover truncated range
+            self.version += 1
+            self.generation += 1
+            self._update()
         return length
 
     def write(self, offset, buf):
@@ -98,7 +455,12 @@ class FragmentCache:
             self.load(offset, offset + len(buf), True)
             self.stream.seek(offset)
             self.stream.write(buf)
+            self.dirty_bytes += sum(
+                gap_end - gap_start for gap_start, gap_end in
+                self.dirty_scope.gaps(offset, offset + len(buf)))
+            self.dirty_scope.add(offset, offset + len(buf))
             self.dirty = True
-            if self.cached_scope[-1] > self.length:
-                self.length = self.cached_scope[-1]
+            self.generation += 1
+            self.length = max(self.length, offset + len(buf))
+            self._update()
         return len(buf)
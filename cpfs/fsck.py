@@ -3,8 +3,36 @@ from __future__ import absolute_import
 from itertools import chain
 from .compatibility import reduce
 from .logger import logger
+from .metadata import METADATA_STORAGE_NAME, METADATA_JOURNAL_NAME
 from stat import S_IFREG, S_IFLNK, S_IFDIR
 
+# objects inserted into objects table at once
+OBJECTS_BATCH = 10000
+# objects listed between progress reports
+OBJECTS_PROGRESS = 100000
+SQL_CREATE_OBJECTS = ';\n'.join((
+    'CREATE TEMP TABLE IF NOT EXISTS objects (\n'
+    'name TEXT PRIMARY KEY,\n'
+    'size INT NOT NULL\n)',
+    'DELETE FROM objects',
+    # objects metadata refers to, packed entries are in packs instead
+    """
+    CREATE TEMP VIEW IF NOT EXISTS expected (name, size) AS
+    SELECT name, size FROM (
+        SELECT CAST(inode AS TEXT) AS name, size
+        FROM inodes
+        WHERE mode & 0xF000 == {0} AND size > 0
+            AND inode NOT IN (SELECT inode FROM layouts)
+        UNION ALL
+        SELECT inode || '.' || block, size FROM blocks WHERE hash IS NULL
+        UNION ALL
+        SELECT 'c' || hash, size FROM chunks
+        UNION ALL
+        SELECT 'p' || pack, size FROM packs)
+    WHERE name NOT IN (SELECT name FROM packed)
+    """.format(S_IFREG),
+))
+
 
 FSCK_RULES = dict((
     # (name,
@@ -56,19 +84,186 @@ FSCK_RULES = dict((
         "",
         (),
     )),
+    ('chunk_refcount', (
+        """
+        SELECT chunks.hash, chunks.refcount,
+            COUNT(blocks.hash) AS real_refcount
+        FROM chunks
+        LEFT JOIN blocks
+        ON chunks.hash = blocks.hash
+        GROUP BY chunks.hash
+        HAVING chunks.refcount != real_refcount
+        """,
+        lambda name, entry: "{}: chunk '{}' refcount '{}' -> '{}'".format(
+            name, *entry
+        ),
+        "UPDATE chunks SET refcount = ? WHERE hash = ?",
+        lambda entry: (entry[2], entry[0]),
+    )),
+    ('missing_chunk', (
+        """
+        SELECT blocks.inode, blocks.block, blocks.hash
+        FROM blocks
+        LEFT OUTER JOIN chunks
+        ON blocks.hash = chunks.hash
+        WHERE blocks.hash IS NOT NULL AND chunks.hash IS NULL
+        """,
+        lambda name, entry: "{}: inode '{}' block '{}' chunk '{}'".format(
+            name, *entry
+        ),
+        "",
+        (),
+    )),
+    ('pack_live', (
+        """
+        SELECT packs.pack, packs.live,
+            COALESCE(SUM(packed.size), 0) AS real_live
+        FROM packs
+        LEFT JOIN packed
+        ON packs.pack = packed.pack
+        GROUP BY packs.pack
+        HAVING packs.live != real_live
+        """,
+        lambda name, entry: "{}: pack '{}' live '{}' -> '{}'".format(
+            name, *entry
+        ),
+        "UPDATE packs SET live = ? WHERE pack = ?",
+        lambda entry: (entry[2], entry[0]),
+    )),
+    ('stale_deletion', (
+        """
+        SELECT name
+        FROM deletions
+        WHERE name IN (
+            SELECT inode || '.' || block FROM blocks WHERE hash IS NULL)
+        OR name IN (SELECT 'c' || hash FROM chunks)
+        OR name IN (SELECT 'p' || pack FROM packs)
+        OR name IN (SELECT name FROM packed)
+        OR name IN (SELECT CAST(inode AS TEXT) FROM inodes)
+        """,
+        lambda name, entry: "{}: object '{}' in use".format(name, *entry),
+        "DELETE FROM deletions WHERE name = ?",
+        lambda entry: entry,
+    )),
+    ('dangling_content', (
+        """
+        SELECT contents.rowid, contents.parent_inode, contents.inode
+        FROM contents
+        LEFT OUTER JOIN inodes
+        ON contents.inode = inodes.inode
+        LEFT OUTER JOIN inodes AS parents
+        ON contents.parent_inode = parents.inode
+        WHERE inodes.inode IS NULL OR parents.inode IS NULL
+        """,
+        lambda name, entry:
+            "{}: entry '{}' of inode '{}' -> inode '{}'".format(
+                name, *entry
+            ),
+        "DELETE FROM contents WHERE rowid = ?",
+        lambda entry: entry[:1],
+    )),
+    # following need objects table, see load_objects
+    ('orphan_object', (
+        """
+        SELECT name, size
+        FROM objects
+        WHERE name NOT IN (SELECT name FROM expected)
+            AND name NOT IN (SELECT name FROM deletions)
+            AND name NOT IN ('{}', '{}')
+        """.format(METADATA_STORAGE_NAME, METADATA_JOURNAL_NAME),
+        lambda name, entry: "{}: object '{}' size '{}'".format(
+            name, *entry
+        ),
+        # deleted by collector on next mount
+        "INSERT INTO deletions (name) VALUES (?)",
+        lambda entry: entry[:1],
+    )),
+    ('missing_object', (
+        """
+        SELECT name, size
+        FROM expected
+        WHERE name NOT IN (SELECT name FROM objects)
+        """,
+        lambda name, entry: "{}: object '{}' size '{}'".format(
+            name, *entry
+        ),
+        "",
+        (),
+    )),
+    ('object_size', (
+        """
+        SELECT expected.name, expected.size, objects.size
+        FROM expected
+        JOIN objects
+        ON expected.name = objects.name
+        WHERE expected.size != objects.size
+        """,
+        lambda name, entry: "{}: object '{}' size '{}' stored '{}'".format(
+            name, *entry
+        ),
+        "",
+        (),
+    )),
 ))
 
+# FSCK_RULES SQL limited to inodes changed since last fsck, rules not here
+# run in full, chunk_refcount too since a chunk whose last reference is
+# dropped belongs to no inode
+INCREMENTAL_FSCK_SQL = {
+    'nlink': """
+        SELECT inodes.inode, inodes.nlink,
+            COUNT(contents.parent_inode) AS real_nlink
+        FROM dirty_inodes
+        JOIN inodes
+        ON dirty_inodes.inode = inodes.inode
+        LEFT JOIN contents
+        ON inodes.inode = contents.inode
+        GROUP BY inodes.inode
+        HAVING inodes.nlink != real_nlink
+        """,
+    'invalid_symlink': """
+        SELECT inodes.inode
+        FROM dirty_inodes
+        JOIN inodes
+        ON dirty_inodes.inode = inodes.inode
+        LEFT OUTER JOIN targets
+        ON inodes.inode = targets.inode
+        WHERE inodes.mode & {0} == {0} AND targets.path IS NULL
+        """.format(S_IFLNK),
+    'invalid_dir_nlink': """
+        SELECT inodes.inode, inodes.nlink
+        FROM dirty_inodes
+        JOIN inodes
+        ON dirty_inodes.inode = inodes.inode
+        WHERE inodes.mode & 0xE000 | {0} == {0} AND inodes.nlink > 1
+        """.format(S_IFDIR),
+    'missing_chunk': """
+        SELECT blocks.inode, blocks.block, blocks.hash
+        FROM dirty_inodes
+        JOIN blocks
+        ON dirty_inodes.inode = blocks.inode
+        LEFT OUTER JOIN chunks
+        ON blocks.hash = chunks.hash
+        WHERE blocks.hash IS NOT NULL AND chunks.hash IS NULL
+        """,
+}
+
 CONVENTIONAL_CHECKS = (
-    'nlink', 'invalid_symlink', 'invalid_dir_nlink'
+    'nlink', 'invalid_symlink', 'invalid_dir_nlink', 'chunk_refcount',
+    'missing_chunk', 'pack_live', 'stale_deletion'
+)
+FULL_CHECKS = (
+    'dangling_content', 'orphan_object', 'missing_object', 'object_size'
 )
 
 
-def do_fsck(name):
+def do_fsck(name, incremental=False):
     fsck_rule = FSCK_RULES[name]
+    sql = incremental and INCREMENTAL_FSCK_SQL.get(name) or fsck_rule[0]
 
     def fsck_func(conn, verbose=False, test=False):
         cur = conn.cursor()
-        list_invalid_entries = cur.execute(fsck_rule[0]).fetchall()
+        list_invalid_entries = cur.execute(sql).fetchall()
         if list_invalid_entries:
             if verbose and fsck_rule[1]:
                 for invalid_entry in list_invalid_entries:
@@ -77,23 +272,70 @@ def do_fsck(name):
                 cur.executemany(fsck_rule[2],
                                 map(fsck_rule[3], list_invalid_entries))
                 conn.commit()
-        return len(list_invalid_entries), test and fsck_rule[2]
+        # whether errors are left uncorrected
+        return len(list_invalid_entries), test or not fsck_rule[2]
 
     return fsck_func
 
 
-def do_fsck_and_return(name, conn, verbose, test):
-    error, test_only = do_fsck(name)(conn, verbose, test)
+def do_fsck_and_return(name, conn, verbose, test, incremental=False):
+    error, uncorrected = do_fsck(name, incremental)(conn, verbose, test)
     if error:
         logger.warning('{} error: {}'.format(
             name.capitalize().replace('_', ' '), error
         ))
-    return error and (test_only and 4 or 1)
+    return error and (uncorrected and 4 or 1)
 
 
-def do_fscks(list_names, conn, verbose, test):
+def do_fscks(list_names, conn, verbose, test, incremental=False):
+    '''
+    Run checks, incrementally only over inodes changed since last fsck if
+    incremental
+    '''
     return reduce(
-        lambda prev_exit_code, name:
-            max(prev_exit_code, do_fsck_and_return(name, conn, verbose, test)),
+        lambda prev_exit_code, name: max(prev_exit_code, do_fsck_and_return(
+            name, conn, verbose, test, incremental)),
         chain((0,), list_names)
     )
+
+
+def clear_dirty_inodes(conn):
+    '''Volume checked clean, return whether anything was cleared'''
+    cur = conn.cursor()
+    cleared = cur.execute("DELETE FROM dirty_inodes").rowcount > 0
+    conn.commit()
+    return cleared
+
+
+def load_objects(storage_op, conn):
+    '''
+    Stream listing of backend objects into temporary objects table, return
+    number of objects
+    '''
+    conn.executescript(SQL_CREATE_OBJECTS)
+    count = 0
+    batch = []
+    for entry in storage_op.list_objects():
+        batch.append(entry)
+        count += 1
+        if len(batch) >= OBJECTS_BATCH:
+            conn.executemany(
+                "INSERT OR REPLACE INTO objects (name, size) VALUES (?, ?)",
+                batch)
+            batch = []
+        if not count % OBJECTS_PROGRESS:
+            logger.info('fsck: {} objects listed'.format(count))
+    conn.executemany(
+        "INSERT OR REPLACE INTO objects (name, size) VALUES (?, ?)", batch)
+    conn.commit()
+    logger.info('fsck: {} objects listed'.format(count))
+    return count
+
+
+def do_full_fscks(storage_op, conn, verbose, test):
+    '''Cross-check backend objects against metadata'''
+    if not hasattr(storage_op, 'list_objects'):
+        logger.warning('Full check: backend cannot list objects')
+        return do_fscks(FULL_CHECKS[:1], conn, verbose, test)
+    load_objects(storage_op, conn)
+    return do_fscks(FULL_CHECKS, conn, verbose, test)
@@ -0,0 +1,140 @@
+'''
+IntervalSet
+Disjoint half-open intervals, boundaries are kept sorted in blocks of
+bounded size so updates move at most a block instead of the whole set
+'''
+from bisect import bisect_left, bisect_right
+
+# boundaries per block, a block is split beyond twice as many
+BLOCK_LOAD = 512
+
+
+class IntervalSet:
+    def __init__(self):
+        # [start, end, start, end, ...], touching intervals are merged
+        self.blocks = []
+        # start of first interval of each block
+        self.firsts = []
+
+    def __iter__(self):
+        for block in self.blocks:
+            for index in range(0, len(block), 2):
+                yield block[index], block[index + 1]
+
+    def __len__(self):
+        return sum(len(block) for block in self.blocks) // 2
+
+    def _locate(self, offset):
+        '''
+        (block index, boundary index) of first interval ending at or after
+        offset
+        '''
+        if not self.blocks:
+            return 0, 0
+        block_index = max(0, bisect_right(self.firsts, offset) - 1)
+        block = self.blocks[block_index]
+        index = bisect_left(block, offset)
+        if index & 1:
+            return block_index, index - 1
+        if index == len(block):
+            return block_index + 1, 0
+        return block_index, index
+
+    def _repair(self, first_block_index, last_block_index):
+        for block_index in range(
+                min(last_block_index, len(self.blocks) - 1),
+                first_block_index - 1, -1):
+            block = self.blocks[block_index]
+            if not block:
+                del self.blocks[block_index], self.firsts[block_index]
+            elif len(block) > BLOCK_LOAD * 2:
+                self.blocks[block_index + 1:block_index + 1] = [
+                    block[:BLOCK_LOAD], block[BLOCK_LOAD:]]
+                del self.blocks[block_index]
+                self.firsts[block_index:block_index + 1] = [
+                    block[0], block[BLOCK_LOAD]]
+            else:
+                self.firsts[block_index] = block[0]
+
+    def add(self, start, end):
+        '''Merge [start, end) with overlapping and touching intervals'''
+        block_index, index = self._locate(start)
+        if block_index == len(self.blocks) and self.blocks:
+            block_index -= 1
+            index = len(self.blocks[block_index])
+        first_block_index, first_index = block_index, index
+        while block_index < len(self.blocks):
+            block = self.blocks[block_index]
+            end_index = bisect_right(block, end, index)
+            # interval starting within [start, end] but ending beyond
+            if end_index & 1:
+                end_index += 1
+            if end_index > index:
+                start = min(start, block[index])
+                end = max(end, block[end_index - 1])
+                del block[index:end_index]
+            if index < len(block):
+                break
+            block_index += 1
+            index = 0
+        if not self.blocks:
+            self.blocks.append([])
+            self.firsts.append(start)
+        self.blocks[first_block_index][first_index:first_index] = [
+            start, end]
+        self._repair(first_block_index, block_index)
+
+    def clear(self):
+        del self.blocks[:], self.firsts[:]
+
+    def covers(self, start, end):
+        block_index, index = self._locate(start)
+        if block_index == len(self.blocks):
+            return False
+        block = self.blocks[block_index]
+        return block[index] <= start and end <= block[index + 1]
+
+    def end(self, offset=None):
+        '''
+        End of interval covering offset, or of last interval if offset is
+        None, None if not any
+        '''
+        if offset is None:
+            return self.blocks[-1][-1] if self.blocks else None
+        block_index, index = self._locate(offset)
+        if block_index < len(self.blocks):
+            start, end = self.blocks[block_index][index:index + 2]
+            if start <= offset < end:
+                return end
+
+    def gaps(self, start, end):
+        '''Ranges between start and end not covered'''
+        list_gaps = []
+        block_index, index = self._locate(start)
+        while block_index < len(self.blocks) and start < end:
+            block = self.blocks[block_index]
+            while index < len(block) and block[index] < end:
+                if start < block[index]:
+                    list_gaps.append((start, block[index]))
+                start = max(start, block[index + 1])
+                index += 2
+            if index < len(block):
+                break
+            block_index += 1
+            index = 0
+        if start < end:
+            list_gaps.append((start, end))
+        return list_gaps
+
+    def truncate(self, length):
+        '''Drop everything from length on'''
+        block_index, index = self._locate(length)
+        if block_index == len(self.blocks):
+            return
+        block = self.blocks[block_index]
+        if block[index] < length:
+            block[index + 1] = length
+            index += 2
+        del block[index:]
+        del self.blocks[block_index + 1:], self.firsts[block_index + 1:]
+        self._repair(block_index, block_index)
@@ -0,0 +1,45 @@
+'''
+LRUCache
+Bounded thread-safe cache filled by a loader function
+'''
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.mutex = Lock()
+        # bumped by every invalidation, a load started before an
+        # invalidation may be stale and is not stored
+        self.version = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, loader):
+        with self.mutex:
+            try:
+                value = self.data.pop(key)
+                self.data[key] = value
+                return value
+            except KeyError:
+                version = self.version
+        value = loader(key)
+        with self.mutex:
+            if version == self.version:
+                self.data[key] = value
+                if len(self.data) > self.maxsize:
+                    self.data.popitem(False)
+        return value
+
+    def invalidate(self, key):
+        with self.mutex:
+            self.version += 1
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.mutex:
+            self.version += 1
+            self.data.clear()
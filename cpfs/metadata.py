@@ -1,14 +1,30 @@
 '''
 MultithreadConnection
-Share sqlite3 connect between multi thread
+Share sqlite3 database between multi thread
 '''
+from __future__ import absolute_import
+
 import os
+import errno
+import fcntl
+import hashlib
+import json
+import shutil
 import sqlite3
+import struct
 import tempfile
 import zlib
-from threading import Lock, Condition
+from base64 import b64decode, b64encode
+from threading import Lock, RLock, Condition, Event, Thread, local
+from .compatibility import PY2, blob_type, pathname2url
+from .container import read_container, read_container_stamp, \
+    write_container
+from .logger import logger
 
 METADATA_STORAGE_NAME = '0'
+METADATA_JOURNAL_NAME = '0.journal'
+# frame: sequence number, length of compressed statements
+JOURNAL_FRAME_HEADER = struct.Struct('>QI')
 
 
 class WriteableCursor(sqlite3.Cursor):
@@ -16,19 +32,26 @@ class WriteableCursor(sqlite3.Cursor):
         super(WriteableCursor, self).__init__(conn)
         self.conn = conn
 
+    def execute(self, sql, parameters=()):
+        cur = super(WriteableCursor, self).execute(sql, parameters)
+        self.conn._record(sql, parameters)
+        return cur
+
+    def executemany(self, sql, parameters=()):
+        parameters = list(parameters)
+        cur = super(WriteableCursor, self).executemany(sql, parameters)
+        self.conn._record(sql, parameters, True)
+        return cur
+
     def __enter__(self):
-        self.conn.waiting_list.append(None)
         self.conn.mutex.acquire()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
+        self.conn.write_seq += 1
+        seq = self.conn.write_seq
         self.conn.mutex.release()
-        self.conn.waiting_list.pop()
-        if not self.conn.waiting_list:
-            try:
-                self.conn.empty.notify()
-            except RuntimeError:
-                pass
+        self.conn.group_commit(seq)
 
     def acquire(self):
         return self.__enter__()
@@ -38,36 +61,104 @@ class WriteableCursor(sqlite3.Cursor):
 
 
 class MultithreadConnection(sqlite3.Connection):
-    def __init__(self, *args, **kwargs):
+    '''
+    Single writer connection in WAL mode, every thread reads from its own
+    read-only connection
+    '''
+    def __init__(self, database, *args, **kwargs):
         super(MultithreadConnection, self).__init__(
-            check_same_thread=False, *args, **kwargs)
-        self.waiting_list = []
+            database, check_same_thread=False, *args, **kwargs)
+        self.database = database
+        self.execute('PRAGMA journal_mode = WAL')
+        # local working copy, durability comes from storage
+        self.execute('PRAGMA synchronous = OFF')
+        # writer
         self.mutex = Lock()
-        self.empty = Condition(self.mutex)
+        # group commit
+        self.write_seq = 0
+        self.commit_seq = 0
+        self.committing = False
+        self.commit_cond = Condition(Lock())
+        # readers
+        self.local = local()
+        self.readers = []
+        self.readers_mutex = Lock()
+
+    def _commit_locked(self):
+        '''Commit with self.mutex held'''
+        seq = self.write_seq
+        super(MultithreadConnection, self).commit()
+        with self.commit_cond:
+            self.commit_seq = max(self.commit_seq, seq)
+            self.commit_cond.notify_all()
+
+    def _connect_reader(self):
+        if PY2:
+            reader = sqlite3.connect(self.database, check_same_thread=False)
+        else:
+            reader = sqlite3.connect(
+                'file:{}?mode=ro'.format(pathname2url(self.database)),
+                uri=True, check_same_thread=False)
+        with self.readers_mutex:
+            self.readers.append(reader)
+        return reader
+
+    def _record(self, sql, parameters, many=False):
+        pass
 
-    def _write_execute(self, method, sql, parameters=()):
-        self.waiting_list.append(None)
+    def _write_execute(self, method, sql, parameters=(), many=False):
         with self.mutex:
             cur = method(sql, parameters)
-        self.waiting_list.pop()
-        if not self.waiting_list:
-            try:
-                self.empty.notify()
-            except RuntimeError:
-                pass
+            self._record(sql, parameters, many)
+            self.write_seq += 1
+            seq = self.write_seq
+        self.group_commit(seq)
         return cur
 
+    def close(self):
+        with self.readers_mutex:
+            for reader in self.readers:
+                reader.close()
+            self.readers = []
+        super(MultithreadConnection, self).close()
+
     def commit(self):
-        with self.empty:
-            while self.waiting_list:
-                self.empty.wait()
-            super(MultithreadConnection, self).commit()
+        with self.mutex:
+            self._commit_locked()
+
+    def group_commit(self, seq):
+        '''
+        Wait until write `seq` is committed, the first waiter commits for
+        all writes done so far
+        '''
+        with self.commit_cond:
+            while self.commit_seq < seq:
+                if self.committing:
+                    self.commit_cond.wait()
+                    continue
+                self.committing = True
+                self.commit_cond.release()
+                try:
+                    with self.mutex:
+                        self._commit_locked()
+                finally:
+                    self.commit_cond.acquire()
+                    self.committing = False
+                    self.commit_cond.notify_all()
+
+    def read_execute(self, sql, parameters=()):
+        try:
+            reader = self.local.reader
+        except AttributeError:
+            reader = self.local.reader = self._connect_reader()
+        return reader.execute(sql, parameters)
 
     def write_execute(self, sql, parameters=()):
         return self._write_execute(self.execute, sql, parameters)
 
     def write_executemany(self, sql, parameters=()):
-        return self._write_execute(self.executemany, sql, parameters)
+        return self._write_execute(
+            self.executemany, sql, list(parameters), True)
 
     def writeable_cursor(self):
         return WriteableCursor(self)
@@ -77,39 +168,340 @@ def connect(*args, **kwargs):
     return MultithreadConnection(*args, **kwargs)
 
 
+def _encode_parameter(value):
+    if isinstance(value, blob_type):
+        return {'b': b64encode(bytes(value)).decode()}
+    return value
+
+
+def _decode_parameter(value):
+    if isinstance(value, dict):
+        return blob_type(b64decode(value['b'].encode()))
+    return value
+
+
+def encode_journal_frame(seq, statements):
+    compressed_statements = zlib.compress(json.dumps([
+        (
+            sql,
+            [list(map(_encode_parameter, row)) for row in parameters]
+            if many else list(map(_encode_parameter, parameters)),
+            many
+        ) for sql, parameters, many in statements
+    ]).encode())
+    return JOURNAL_FRAME_HEADER.pack(
+        seq, len(compressed_statements)) + compressed_statements
+
+
+def decode_journal(journal):
+    offset = 0
+    while offset + JOURNAL_FRAME_HEADER.size <= len(journal):
+        seq, length = JOURNAL_FRAME_HEADER.unpack_from(journal, offset)
+        offset += JOURNAL_FRAME_HEADER.size
+        if offset + length > len(journal):
+            # torn write of the last frame
+            logger.warning('metadata journal: frame {} truncated'.format(seq))
+            break
+        statements = json.loads(
+            zlib.decompress(journal[offset:offset + length]).decode())
+        offset += length
+        yield seq, [
+            (
+                sql,
+                [list(map(_decode_parameter, row)) for row in parameters]
+                if many else list(map(_decode_parameter, parameters)),
+                many
+            ) for sql, parameters, many in statements
+        ]
+
+
+def default_cache_dir():
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'), 'cpfs')
+
+
+def parser_add_metadata_cache(parser):
+    parser.add_argument(
+        '--metadata-cache', dest='metadata_cache', metavar='DIR',
+        default=default_cache_dir(),
+        help='keep metadata in DIR between runs, empty to disable')
+
+
+class MetadataCache:
+    '''
+    Local copy of metadata database, keyed by storage url and valid while
+    remote snapshot (size, generation stamp) is unchanged
+    '''
+    def __init__(self, cache_dir, url):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        key = os.path.join(
+            cache_dir, hashlib.sha1(url.encode()).hexdigest())
+        self.db_path = key + '.db'
+        self.stamp_path = key + '.stamp'
+        self.lock_fh = open(key + '.lock', 'a')
+
+    def claim(self, stamp):
+        '''
+        Lock cache for this process and invalidate it until released
+        Return whether cached database matches remote `stamp`
+        '''
+        try:
+            fcntl.flock(self.lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logger.warning('metadata cache: in use by another process')
+            self.lock_fh.close()
+            return None
+        try:
+            with open(self.stamp_path) as stamp_fh:
+                cached_stamp = tuple(json.load(stamp_fh))
+            os.remove(self.stamp_path)
+        except (IOError, OSError, ValueError):
+            cached_stamp = None
+        return stamp[1] is not None and cached_stamp == tuple(stamp) and \
+            os.path.exists(self.db_path)
+
+    def release(self, stamp=None):
+        if stamp and stamp[1] is not None:
+            with open(self.stamp_path + '.tmp', 'w') as stamp_fh:
+                json.dump(stamp, stamp_fh)
+            os.rename(self.stamp_path + '.tmp', self.stamp_path)
+        elif os.path.exists(self.db_path):
+            os.remove(self.db_path)
+        fcntl.flock(self.lock_fh, fcntl.LOCK_UN)
+        self.lock_fh.close()
+
+
 class TmpMetadataConnection(MultithreadConnection):
-    def __init__(self, compressed_data=None):
-        fd, self.tmpfile_path = tempfile.mkstemp()
+    def __init__(self, storage_op=None, cache=None):
+        # (size, generation stamp) of remote snapshot
+        self.stamp = None
+        self.cache = None
+        cached = False
+        if storage_op:
+            self.stamp = read_container_stamp(
+                storage_op, METADATA_STORAGE_NAME)
+            if cache:
+                cached = cache.claim(self.stamp)
+                if cached is not None:
+                    self.cache = cache
+        if self.cache:
+            self.tmpfile_path = self.cache.db_path
+            fd = None
+            if not cached:
+                # stale WAL would be applied to the new database
+                for suffix in ('-wal', '-shm'):
+                    if os.path.exists(self.tmpfile_path + suffix):
+                        os.remove(self.tmpfile_path + suffix)
+                fd = os.open(
+                    self.tmpfile_path,
+                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        else:
+            fd, self.tmpfile_path = tempfile.mkstemp()
         try:
-            with os.fdopen(fd, 'wb') as tmpfile_fh:
-                if compressed_data:
-                    tmpfile_fh.write(zlib.decompress(compressed_data))
+            if fd is not None:
+                with os.fdopen(fd, 'wb') as tmpfile_fh:
+                    if storage_op:
+                        read_container(
+                            storage_op, METADATA_STORAGE_NAME, tmpfile_fh)
         except:
-            os.remove(self.tmpfile_path)
+            self._remove()
             raise
         super(TmpMetadataConnection, self).__init__(self.tmpfile_path)
+        # statements not yet shipped to journal
+        self.journal = []
+        self.execute(
+            "CREATE TABLE IF NOT EXISTS journal (seq INT NOT NULL)")
+        if not self.execute("SELECT seq FROM journal").fetchone():
+            self.execute("INSERT INTO journal (seq) VALUES (0)")
+        self.journal_seq, = self.execute("SELECT seq FROM journal").fetchone()
+        super(MultithreadConnection, self).commit()
 
-    def dump(self):
-        self.commit()
-        with open(self.tmpfile_path, 'rb') as tmpfile_file:
-            return zlib.compress(tmpfile_file.read())
+    def _record(self, sql, parameters, many=False):
+        if sql.lstrip()[:6].upper() != 'SELECT':
+            self.journal.append((sql, parameters, many))
 
-    def close(self):
-        super(TmpMetadataConnection, self).close()
-        os.remove(self.tmpfile_path)
+    def _set_journal_seq(self, seq):
+        self.journal_seq = seq
+        self.execute("UPDATE journal SET seq = ?", (seq,))
+        self._commit_locked()
+
+    def dump(self, storage_op):
+        fd, snapshot_path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with self.mutex:
+                # everything in journal is contained in the snapshot
+                self.journal = []
+                self._commit_locked()
+                shutil.copyfile(self.tmpfile_path, snapshot_path)
+                if os.path.exists(self.tmpfile_path + '-wal'):
+                    shutil.copyfile(
+                        self.tmpfile_path + '-wal', snapshot_path + '-wal')
+            # fold WAL into the copy, then compress and upload without
+            # blocking writers
+            snapshot_conn = sqlite3.connect(snapshot_path)
+            snapshot_conn.execute('PRAGMA journal_mode = DELETE')
+            snapshot_conn.close()
+            with open(snapshot_path, 'rb') as snapshot_fh:
+                self.stamp = write_container(
+                    storage_op, METADATA_STORAGE_NAME, snapshot_fh)
+        finally:
+            for path in (snapshot_path, snapshot_path + '-wal'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def dump_journal(self):
+        with self.mutex:
+            if not self.journal:
+                return b''
+            statements, self.journal = self.journal, []
+            self._set_journal_seq(self.journal_seq + 1)
+            return encode_journal_frame(self.journal_seq, statements)
+
+    def replay(self, journal):
+        with self.mutex:
+            for seq, statements in decode_journal(journal):
+                if seq <= self.journal_seq:
+                    continue
+                for sql, parameters, many in statements:
+                    if many:
+                        self.executemany(sql, parameters)
+                    else:
+                        self.execute(sql, parameters)
+                self._set_journal_seq(seq)
+
+    def _remove(self):
+        if self.cache:
+            self.cache.release()
+        else:
+            os.remove(self.tmpfile_path)
+
+    def close(self, persist=False):
+        '''
+        Keep database in cache if `persist`, caller must ensure everything
+        is shipped to storage
+        '''
+        if persist and self.cache:
+            super(MultithreadConnection, self).commit()
+            super(TmpMetadataConnection, self).close()
+            self.cache.release(self.stamp)
+        else:
+            super(TmpMetadataConnection, self).close()
+            self._remove()
 
 
-def read_metadata(storage_op):
-    storage_op.open(METADATA_STORAGE_NAME)
-    dump = storage_op.read(
-        METADATA_STORAGE_NAME, 0, storage_op.size(METADATA_STORAGE_NAME))
-    storage_op.close(METADATA_STORAGE_NAME)
+def read_metadata(storage_op, name=METADATA_STORAGE_NAME):
+    storage_op.open(name)
+    dump = storage_op.read(name, 0, storage_op.size(name))
+    storage_op.close(name)
     return dump
 
 
-def write_metadata(storage_op, dump):
-    storage_op.open(METADATA_STORAGE_NAME)
-    storage_op.write(METADATA_STORAGE_NAME, 0, dump)
-    storage_op.truncate(METADATA_STORAGE_NAME, len(dump))
-    storage_op.flush(METADATA_STORAGE_NAME)
-    storage_op.close(METADATA_STORAGE_NAME)
+def _not_found(e):
+    '''Backends raise ENOENT for missing objects, other errors may pass'''
+    return isinstance(e, EnvironmentError) and e.errno == errno.ENOENT
+
+
+def read_journal(storage_op):
+    try:
+        return read_metadata(storage_op, METADATA_JOURNAL_NAME)
+    except EnvironmentError as e:
+        # a journal failed to read must not be replaced by an empty one
+        if not _not_found(e):
+            raise
+        storage_op.create(METADATA_JOURNAL_NAME)
+        return b''
+
+
+def _open_or_create(storage_op, name):
+    try:
+        storage_op.open(name)
+    except EnvironmentError as e:
+        if not _not_found(e):
+            raise
+        storage_op.create(name)
+        storage_op.open(name)
+
+
+def journal_size(storage_op):
+    _open_or_create(storage_op, METADATA_JOURNAL_NAME)
+    size = storage_op.size(METADATA_JOURNAL_NAME)
+    storage_op.close(METADATA_JOURNAL_NAME)
+    return size
+
+
+def append_journal(storage_op, frame):
+    _open_or_create(storage_op, METADATA_JOURNAL_NAME)
+    storage_op.write(
+        METADATA_JOURNAL_NAME, storage_op.size(METADATA_JOURNAL_NAME), frame)
+    storage_op.flush(METADATA_JOURNAL_NAME)
+    storage_op.close(METADATA_JOURNAL_NAME)
+
+
+def load_metadata(storage_op, cache=None):
+    conn = TmpMetadataConnection(storage_op, cache)
+    conn.replay(read_journal(storage_op))
+    return conn
+
+
+def save_metadata(storage_op, conn):
+    '''Write full snapshot, then drop the journal folded into it'''
+    conn.dump(storage_op)
+    _open_or_create(storage_op, METADATA_JOURNAL_NAME)
+    storage_op.truncate(METADATA_JOURNAL_NAME, 0)
+    storage_op.flush(METADATA_JOURNAL_NAME)
+    storage_op.close(METADATA_JOURNAL_NAME)
+
+
+class JournalShipper(Thread):
+    '''
+    Ship metadata journal every `interval` seconds, compact it into a new
+    snapshot once it grows over `compact_size` bytes
+    '''
+    def __init__(self, conn, storage_op, interval=60, compact_size=1 << 24):
+        super(JournalShipper, self).__init__()
+        self.daemon = True
+        self.conn = conn
+        self.storage_op = storage_op
+        self.interval = interval
+        self.compact_size = compact_size
+        self.journal_size = journal_size(storage_op)
+        # a frame failed to ship, journal is useless until next snapshot
+        self.broken = False
+        self.mutex = RLock()
+        self.stopped = Event()
+
+    def compact(self):
+        with self.mutex:
+            save_metadata(self.storage_op, self.conn)
+            self.journal_size = 0
+            self.broken = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sync()
+                if self.journal_size > self.compact_size:
+                    self.compact()
+            except Exception:
+                logger.exception('metadata journal: ship failed')
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def sync(self):
+        with self.mutex:
+            if self.broken:
+                return self.compact()
+            frame = self.conn.dump_journal()
+            if frame:
+                try:
+                    append_journal(self.storage_op, frame)
+                except:
+                    self.broken = True
+                    raise
+                self.journal_size += len(frame)
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 from .compatibility import blob_type
+from .logger import logger
 from stat import *
 from time import time
 from collections import OrderedDict
@@ -43,12 +44,17 @@ def sql_create_db(db_structure):
         ),
         # INDEX
         (
-            'CREATE INDEX {} ON {} ({})'.format(*index_structure)
+            sql_create_index(index_structure)
             for index_structure in db_structure[2]
         ),
     ))
 
 
+def sql_create_index(index_structure):
+    return 'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+        *index_structure)
+
+
 METADATA_DB_PRAGMA = (
     ('foreign_keys', 'true'),
 )
@@ -90,19 +96,143 @@ TABLE_XATTRS_STRUCTURE = OrderedDict((
 TABLE_XATTRS_UNIQUE = (
     ('inode', 'key'),
 )
+TABLE_LAYOUTS_STRUCTURE = OrderedDict((
+    ('inode', 'INTEGER PRIMARY KEY'),
+    ('blksize', 'INT NOT NULL'),
+))
+TABLE_LAYOUTS_FOREIGN_KEY = (
+    ('inode', 'inodes', 'inode'),
+)
+TABLE_BLOCKS_STRUCTURE = OrderedDict((
+    ('rowid', 'INTEGER PRIMARY KEY'),
+    ('inode', 'INT NOT NULL REFERENCES inodes(inode)'),
+    ('block', 'INT NOT NULL'),
+    ('size', 'INT NOT NULL DEFAULT 0'),
+    ('hash', 'TEXT'),
+))
+TABLE_BLOCKS_UNIQUE = (
+    ('inode', 'block'),
+)
+TABLE_CHUNKS_STRUCTURE = OrderedDict((
+    ('hash', 'TEXT PRIMARY KEY'),
+    ('size', 'INT NOT NULL'),
+    ('refcount', 'INT NOT NULL DEFAULT 0'),
+))
+TABLE_PACKS_STRUCTURE = OrderedDict((
+    ('pack', 'INTEGER PRIMARY KEY'),
+    ('size', 'INT NOT NULL DEFAULT 0'),
+    # bytes of entries not removed or replaced
+    ('live', 'INT NOT NULL DEFAULT 0'),
+))
+TABLE_PACKED_STRUCTURE = OrderedDict((
+    ('name', 'TEXT PRIMARY KEY'),
+    ('pack', 'INT NOT NULL REFERENCES packs(pack)'),
+    ('offset', 'INT NOT NULL'),
+    ('size', 'INT NOT NULL'),
+))
+TABLE_INLINE_STRUCTURE = OrderedDict((
+    ('inode', 'INTEGER PRIMARY KEY'),
+    ('data', 'BLOB NOT NULL'),
+))
+TABLE_INLINE_FOREIGN_KEY = (
+    ('inode', 'inodes', 'inode'),
+)
+TABLE_DELETIONS_STRUCTURE = OrderedDict((
+    ('name', 'TEXT PRIMARY KEY'),
+))
+# inodes changed since last fsck
+TABLE_DIRTY_INODES_STRUCTURE = OrderedDict((
+    ('inode', 'INTEGER PRIMARY KEY'),
+))
+TABLE_SCHEMA_VERSION_STRUCTURE = OrderedDict((
+    ('version', 'INT NOT NULL'),
+))
+# rowid is implied, readdir pages in (parent_inode, rowid) order
+INDEX_CONTENTS_PARENT = ('parent_index', 'contents', 'parent_inode')
+INDEX_CONTENTS_INODE = ('inode_index', 'contents', 'inode')
+INDEX_BLOCKS_HASH = ('hash_index', 'blocks', 'hash')
+INDEX_PACKED_PACK = ('pack_index', 'packed', 'pack')
 METADATA_DB_STRUCTURE = (
     METADATA_DB_PRAGMA,
     (
         ('inodes', TABLE_INODES_STRUCTURE, (), ()),
         ('contents', TABLE_CONTENTS_STRUCTURE, TABLE_CONTENTS_UNIQUE, ()),
         ('targets', TABLE_TARGETS_STRUCTURE, (), TABLE_TARGETS_FOREIGN_KEY),
-        ('xattrs', TABLE_XATTRS_STRUCTURE, TABLE_XATTRS_UNIQUE, ())),
+        ('xattrs', TABLE_XATTRS_STRUCTURE, TABLE_XATTRS_UNIQUE, ()),
+        ('schema_version', TABLE_SCHEMA_VERSION_STRUCTURE, (), ()),
+        ('layouts', TABLE_LAYOUTS_STRUCTURE, (), TABLE_LAYOUTS_FOREIGN_KEY),
+        ('blocks', TABLE_BLOCKS_STRUCTURE, TABLE_BLOCKS_UNIQUE, ()),
+        ('chunks', TABLE_CHUNKS_STRUCTURE, (), ()),
+        ('packs', TABLE_PACKS_STRUCTURE, (), ()),
+        ('packed', TABLE_PACKED_STRUCTURE, (), ()),
+        ('inline', TABLE_INLINE_STRUCTURE, (), TABLE_INLINE_FOREIGN_KEY),
+        ('deletions', TABLE_DELETIONS_STRUCTURE, (), ()),
+        ('dirty_inodes', TABLE_DIRTY_INODES_STRUCTURE, (), ())),
     (
-        # ('inode_index', 'contents', 'inode'),
+        INDEX_CONTENTS_PARENT,
+        INDEX_CONTENTS_INODE,
+        INDEX_BLOCKS_HASH,
+        INDEX_PACKED_PACK,
     )
 )
 SQL_CREATE_METADATA_DB = sql_create_db(METADATA_DB_STRUCTURE)
 
+# METADATA_MIGRATIONS[n]: SQL upgrading schema version n to n + 1
+METADATA_MIGRATIONS = (
+    ';\n'.join((
+        'CREATE TABLE schema_version (\nversion INT NOT NULL\n)',
+        'CREATE INDEX IF NOT EXISTS parent_index '
+        'ON contents (parent_inode, name)',
+        'CREATE INDEX IF NOT EXISTS inode_index ON contents (inode)',
+        'INSERT INTO schema_version (version) VALUES (0)',
+    )),
+    ';\n'.join((
+        'DROP INDEX parent_index',
+        sql_create_index(INDEX_CONTENTS_PARENT),
+    )),
+    ';\n'.join((
+        'CREATE TABLE layouts (\n'
+        'inode INTEGER PRIMARY KEY,\n'
+        'blksize INT NOT NULL,\n'
+        'FOREIGN KEY (inode) REFERENCES inodes(inode)\n)',
+        'CREATE TABLE blocks (\n'
+        'rowid INTEGER PRIMARY KEY,\n'
+        'inode INT NOT NULL REFERENCES inodes(inode),\n'
+        'block INT NOT NULL,\n'
+        'size INT NOT NULL DEFAULT 0,\n'
+        'UNIQUE (inode, block)\n)',
+    )),
+    ';\n'.join((
+        'ALTER TABLE blocks ADD COLUMN hash TEXT',
+        sql_create_db(((), (('chunks', TABLE_CHUNKS_STRUCTURE, (), ()),), (
+            INDEX_BLOCKS_HASH,
+        ))),
+    )),
+    ';\n'.join((
+        'CREATE TABLE packs (\n'
+        'pack INTEGER PRIMARY KEY,\n'
+        'size INT NOT NULL DEFAULT 0,\n'
+        'live INT NOT NULL DEFAULT 0\n)',
+        'CREATE TABLE packed (\n'
+        'name TEXT PRIMARY KEY,\n'
+        'pack INT NOT NULL REFERENCES packs(pack),\n'
+        'offset INT NOT NULL,\n'
+        'size INT NOT NULL\n)',
+        sql_create_index(INDEX_PACKED_PACK),
+    )),
+    'CREATE TABLE inline (\n'
+    'inode INTEGER PRIMARY KEY,\n'
+    'data BLOB NOT NULL,\n'
+    'FOREIGN KEY (inode) REFERENCES inodes(inode)\n)',
+    'CREATE TABLE deletions (\nname TEXT PRIMARY KEY\n)',
+    ';\n'.join((
+        'CREATE TABLE dirty_inodes (\ninode INTEGER PRIMARY KEY\n)',
+        # never checked incrementally, next fsck checks everything
+        'INSERT INTO dirty_inodes (inode) SELECT inode FROM inodes',
+    )),
+)
+METADATA_SCHEMA_VERSION = len(METADATA_MIGRATIONS)
+
 
 def init_metadata_db(conn, uid=0, gid=0):
     cur = conn.cursor()
@@ -116,4 +246,36 @@ def init_metadata_db(conn, uid=0, gid=0):
     cur.execute(
         "INSERT INTO contents (name, parent_inode, inode) VALUES (?,?,?)",
         (blob_type(b'..'), ROOT_INODE, ROOT_INODE))
+    cur.execute(
+        "INSERT INTO schema_version (version) VALUES (?)",
+        (METADATA_SCHEMA_VERSION,))
     conn.commit()
+
+
+def get_schema_version(conn):
+    if not conn.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type='table' AND name='schema_version'").fetchone():
+        return 0
+    return conn.execute("SELECT version FROM schema_version").fetchone()[0]
+
+
+def migrate_metadata_db(conn):
+    '''
+    Upgrade metadata database in place
+    Return whether anything changed, caller should then save a snapshot
+    '''
+    old_version = get_schema_version(conn)
+    if old_version > METADATA_SCHEMA_VERSION:
+        raise ValueError(
+            'metadata schema version {} newer than supported {}'.format(
+                old_version, METADATA_SCHEMA_VERSION))
+    for version in range(old_version, METADATA_SCHEMA_VERSION):
+        logger.info('metadata schema: upgrade {} -> {}'.format(
+            version, version + 1))
+        cur = conn.cursor()
+        cur.executescript(METADATA_MIGRATIONS[version])
+        cur.execute(
+            "UPDATE schema_version SET version = ?", (version + 1,))
+        conn.commit()
+    return old_version != METADATA_SCHEMA_VERSION
@@ -0,0 +1,332 @@
+'''
+PackStorageOperations
+Wrap StorageOperations of a backend, small objects are appended into large
+pack objects indexed in metadata, so storing one costs bandwidth rather
+than a request, and packs mostly of dead entries are rewritten in
+background
+'''
+from __future__ import absolute_import
+
+from threading import Condition, RLock, Thread
+from .blocks import BlockAttr
+from .compatibility import getargspec
+from .logger import logger
+
+# object name of pack
+PACK_NAME_PREFIX = 'p'
+
+
+class PackedObject:
+    '''Small object being accessed, kept in memory until appended'''
+    def __init__(self, data, modified=False):
+        self.data = bytearray(data)
+        self.modified = modified
+        self.refcount = 0
+
+
+class PackStorageOperations:
+    '''
+    Objects up to threshold bytes are kept in memory while opened, and
+    appended to the pack being filled once closed or flushed
+    A pack is stored once it reaches pack_size, is synced, or has waited
+    for interval seconds, entries are indexed only after that
+    Objects growing beyond threshold are stored on their own, and so are
+    all objects if threshold is 0, packed ones are still read from packs
+    '''
+    def __init__(self, storage_op, conn, threshold=1 << 16,
+                 pack_size=1 << 24, repack_ratio=0.5, interval=30):
+        self.storage_op = storage_op
+        self.conn = conn
+        self.threshold = threshold
+        self.pack_size = pack_size
+        # packs with less live data than this ratio are rewritten
+        self.repack_ratio = repack_ratio
+        self.interval = interval
+        self.open_with_attr = 'attr' in getargspec(storage_op.open).args
+        self.sync_object = getattr(storage_op, 'sync', storage_op.flush)
+        # name -> PackedObject
+        self.dict_objects = {}
+        # pack being filled, None if not any
+        self.pack = None
+        self.pack_buffer = bytearray()
+        # name -> (offset, size) in pack being filled
+        self.dict_appended = {}
+        # packs opened in backend
+        self.set_opened_packs = set()
+        self.closed = False
+        self.mutex = RLock()
+        self.changed = Condition(self.mutex)
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def _name(pack):
+        return PACK_NAME_PREFIX + str(pack)
+
+    def _append(self, name, data):
+        '''Append to pack being filled, replacing earlier content'''
+        with self.mutex:
+            if self.pack is None:
+                self.pack = self.conn.write_execute(
+                    "INSERT INTO packs (size, live) VALUES (0, 0)"
+                ).lastrowid
+            self.dict_appended[name] = (len(self.pack_buffer), len(data))
+            self.pack_buffer += data
+            if len(self.pack_buffer) >= self.pack_size:
+                self._seal()
+
+    def _locate(self, name):
+        '''(pack, offset, size) of stored entry, None if not packed'''
+        return self.conn.read_execute(
+            "SELECT pack, offset, size FROM packed WHERE name = ?",
+            (name,)).fetchone()
+
+    def _open(self, name, attr=None):
+        if self.open_with_attr:
+            self.storage_op.open(name, attr)
+        else:
+            self.storage_op.open(name)
+
+    def _open_pack(self, pack):
+        name = self._name(pack)
+        with self.mutex:
+            if pack not in self.set_opened_packs:
+                size, = self.conn.read_execute(
+                    "SELECT size FROM packs WHERE pack = ?",
+                    (pack,)).fetchone()
+                self._open(name, BlockAttr(size))
+                self.set_opened_packs.add(pack)
+        return name
+
+    def _read_packed(self, name):
+        '''Content of packed object, None if not packed'''
+        with self.mutex:
+            if name in self.dict_appended:
+                offset, size = self.dict_appended[name]
+                return bytes(self.pack_buffer[offset:offset + size])
+            location = self._locate(name)
+            if location is None:
+                return None
+            pack, offset, size = location
+            pack_name = self._open_pack(pack)
+        return self.storage_op.read(pack_name, offset, size)
+
+    def _release(self, pack, size):
+        '''Account dead entry of stored pack, remove pack once all dead'''
+        self.conn.write_execute(
+            "UPDATE packs SET live = live - ? WHERE pack = ?", (size, pack))
+        if self.conn.read_execute(
+                "SELECT live FROM packs WHERE pack = ?",
+                (pack,)).fetchone()[0] > 0:
+            return
+        # backends may only remove opened objects
+        self.storage_op.remove(self._open_pack(pack))
+        self.set_opened_packs.discard(pack)
+        self.conn.write_execute("DELETE FROM packs WHERE pack = ?", (pack,))
+
+    def _repack(self):
+        for pack, in self.conn.read_execute(
+                "SELECT pack FROM packs WHERE live < size * ?",
+                (self.repack_ratio,)).fetchall():
+            if pack == self.pack:
+                continue
+            for name, offset, size in self.conn.read_execute(
+                    "SELECT name, offset, size FROM packed WHERE pack = ?",
+                    (pack,)).fetchall():
+                with self.mutex:
+                    if self.closed:
+                        return
+                    if self._locate(name) != (pack, offset, size):
+                        continue
+                    pack_name = self._open_pack(pack)
+                data = self.storage_op.read(pack_name, offset, size)
+                with self.mutex:
+                    # skip if replaced or removed meanwhile
+                    if name not in self.dict_objects and \
+                            name not in self.dict_appended and \
+                            self._locate(name) == (pack, offset, size):
+                        self._append(name, data)
+            logger.debug('pack: repacked {}'.format(self._name(pack)))
+
+    def _run(self):
+        while True:
+            with self.mutex:
+                if not self.closed:
+                    self.changed.wait(self.interval)
+                if self.closed:
+                    break
+                self._seal()
+            try:
+                self._repack()
+            except Exception as e:
+                logger.warning('pack: repack failed: {}'.format(e))
+
+    def _seal(self):
+        '''Store pack being filled and index its entries'''
+        with self.mutex:
+            if self.pack is None:
+                return
+            pack, self.pack = self.pack, None
+            buf, self.pack_buffer = bytes(self.pack_buffer), bytearray()
+            dict_appended, self.dict_appended = self.dict_appended, {}
+            if not dict_appended:
+                self.conn.write_execute(
+                    "DELETE FROM packs WHERE pack = ?", (pack,))
+                return
+            name = self._name(pack)
+            self.storage_op.create(name)
+            self._open(name, BlockAttr(0))
+            self.storage_op.write(name, 0, buf)
+            self.storage_op.flush(name)
+            self.storage_op.close(name)
+            self.conn.write_execute(
+                "UPDATE packs SET size = ?, live = ? WHERE pack = ?", (
+                    len(buf),
+                    sum(size for _, size in dict_appended.values()), pack))
+            for entry_name, (offset, size) in dict_appended.items():
+                location = self._locate(entry_name)
+                self.conn.write_execute(
+                    "INSERT OR REPLACE INTO packed (name, pack, offset, size) "
+                    "VALUES (?, ?, ?, ?)", (entry_name, pack, offset, size))
+                if location:
+                    self._release(location[0], location[2])
+
+    def _unpack(self, name, packed_object):
+        '''Store object on its own once it grows beyond threshold'''
+        self.storage_op.create(name)
+        for _ in range(packed_object.refcount):
+            self._open(name, BlockAttr(0))
+        self.storage_op.write(name, 0, bytes(packed_object.data))
+        del self.dict_objects[name]
+        self.dict_appended.pop(name, None)
+        location = self._locate(name)
+        if location:
+            self.conn.write_execute(
+                "DELETE FROM packed WHERE name = ?", (name,))
+            self._release(location[0], location[2])
+
+    def close(self, name):
+        with self.mutex:
+            packed_object = self.dict_objects.get(name)
+            if packed_object is not None:
+                packed_object.refcount -= 1
+                if packed_object.refcount < 1:
+                    del self.dict_objects[name]
+                    if packed_object.modified:
+                        self._append(name, packed_object.data)
+                return
+        self.storage_op.close(name)
+
+    def create(self, name):
+        if not self.threshold:
+            return self.storage_op.create(name)
+        with self.mutex:
+            self.dict_objects[name] = PackedObject(b'', True)
+
+    def destory(self):
+        self.stop()
+        with self.mutex:
+            for pack in self.set_opened_packs:
+                self.storage_op.close(self._name(pack))
+            self.set_opened_packs.clear()
+        self.storage_op.destory()
+
+    def flush(self, name):
+        with self.mutex:
+            packed_object = self.dict_objects.get(name)
+            if packed_object is not None:
+                if packed_object.modified:
+                    self._append(name, packed_object.data)
+                    packed_object.modified = False
+                return
+        self.storage_op.flush(name)
+
+    def open(self, name, attr=None):
+        with self.mutex:
+            packed_object = self.dict_objects.get(name)
+            if packed_object is None:
+                data = self._read_packed(name)
+                if data is None:
+                    return self._open(name, attr)
+                packed_object = PackedObject(data)
+                self.dict_objects[name] = packed_object
+            packed_object.refcount += 1
+
+    def read(self, name, offset, length):
+        with self.mutex:
+            packed_object = self.dict_objects.get(name)
+            if packed_object is not None:
+                return bytes(packed_object.data[offset:offset + length])
+        return self.storage_op.read(name, offset, length)
+
+    def remove(self, name):
+        with self.mutex:
+            packed_object = self.dict_objects.pop(name, None)
+            appended = self.dict_appended.pop(name, None)
+            location = self._locate(name)
+            if location:
+                self.conn.write_execute(
+                    "DELETE FROM packed WHERE name = ?", (name,))
+                self._release(location[0], location[2])
+            if packed_object or appended or location:
+                return
+        self.storage_op.remove(name)
+
+    def size(self, name):
+        with self.mutex:
+            packed_object = self.dict_objects.get(name)
+            if packed_object is not None:
+                return len(packed_object.data)
+        return self.storage_op.size(name)
+
+    def statfs(self):
+        return self.storage_op.statfs()
+
+    def stop(self):
+        '''Stop repacking and store pack being filled'''
+        with self.mutex:
+            self.closed = True
+            self.changed.notify()
+        self.thread.join()
+        self._seal()
+
+    def sync(self, name):
+        '''Store pack holding name if not yet, and sync it'''
+        with self.mutex:
+            # other objects may be closed already, only held ones need flush
+            if name in self.dict_objects:
+                self.flush(name)
+            if name in self.dict_appended:
+                self._seal()
+            location = self._locate(name)
+        self.sync_object(location and self._name(location[0]) or name)
+
+    def truncate(self, name, length):
+        with self.mutex:
+            packed_object = self.dict_objects.get(name)
+            if packed_object is not None:
+                if length > self.threshold:
+                    self._unpack(name, packed_object)
+                else:
+                    del packed_object.data[length:]
+                    packed_object.data += b'\0' * (
+                        length - len(packed_object.data))
+                    packed_object.modified = True
+                    return length
+        return self.storage_op.truncate(name, length)
+
+    def write(self, name, offset, buf):
+        with self.mutex:
+            packed_object = self.dict_objects.get(name)
+            if packed_object is not None:
+                if offset + len(buf) > self.threshold:
+                    self._unpack(name, packed_object)
+                else:
+                    data = packed_object.data
+                    if len(data) < offset:
+                        data += b'\0' * (offset - len(data))
+                    data[offset:offset + len(buf)] = buf
+                    packed_object.modified = True
+                    return len(buf)
+        return self.storage_op.write(name, offset, buf)
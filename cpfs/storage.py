@@ -1,8 +1,7 @@
 from __future__ import absolute_import
 
-import imp
 import os
-from .compatibility import urlparse
+from .compatibility import load_source, urlparse
 
 
 def parser_add_url(parser):
@@ -14,7 +13,7 @@ def parser_add_url(parser):
 
 def init_storage_operations(url, mount_arguments=''):
     parsed_url = urlparse(url)
-    return imp.load_source(
+    return load_source(
         'remote',
         os.path.join(
             os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
@@ -0,0 +1,200 @@
+'''
+UploadScheduler
+Upload dirty objects with a pool of workers, most urgent first, and hold
+writers back while too much dirty data is waiting
+'''
+from __future__ import absolute_import
+
+import heapq
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+from .logger import logger
+
+# priority classes, lower first
+PRIORITY_METADATA = 0
+PRIORITY_SYNC = 1
+PRIORITY_BACKGROUND = 2
+# seconds throughput is averaged over
+THROUGHPUT_WINDOW = 60
+
+
+class UploadScheduler:
+    def __init__(self, upload, workers=4, high_water=1 << 30,
+                 low_water=None):
+        # upload(name) -> bytes uploaded, requeue itself on failure
+        self.upload = upload
+        # dirty bytes writers are blocked beyond, until down to low_water
+        self.high_water = high_water
+        self.low_water = high_water // 2 if low_water is None else low_water
+        # name -> dirty bytes
+        self.dict_dirty = {}
+        self.dirty_bytes = 0
+        # heap of [(priority class, size), sequence, name], entries of
+        # cancelled names are left in heap with name None
+        self.heap_pending = []
+        self.dict_pending = {}
+        # heap of (time due, sequence, name, priority)
+        self.heap_delayed = []
+        self.sequence = 0
+        # name -> priority queued while uploading
+        self.dict_uploading = {}
+        # (time finished, bytes uploaded) within throughput window
+        self.queue_uploaded = deque()
+        self.uploaded_bytes = 0
+        self.closed = False
+        self.mutex = Lock()
+        self.changed = Condition(self.mutex)
+        self.list_workers = [
+            Thread(target=self._work) for _ in range(workers)]
+        for worker in self.list_workers:
+            worker.daemon = True
+            worker.start()
+
+    def _pending_bytes(self):
+        return sum(
+            self.dict_dirty.get(name, 0) for name in
+            set(self.dict_pending) | set(self.dict_uploading))
+
+    def _prune(self):
+        while self.queue_uploaded and \
+                self.queue_uploaded[0][0] < time.time() - THROUGHPUT_WINDOW:
+            self.queue_uploaded.popleft()
+
+    def _push(self, name, priority):
+        entry = self.dict_pending.get(name)
+        if entry is not None:
+            if entry[0] <= priority:
+                return
+            # raise priority
+            entry[2] = None
+        self.sequence += 1
+        entry = [priority, self.sequence, name]
+        self.dict_pending[name] = entry
+        heapq.heappush(self.heap_pending, entry)
+        self.changed.notify()
+
+    def _take(self):
+        '''Next name to upload, None if closed and nothing left'''
+        while True:
+            now = time.time()
+            # delays are not waited for once closed
+            while self.heap_delayed and (
+                    self.closed or self.heap_delayed[0][0] <= now):
+                _, _, name, priority = heapq.heappop(self.heap_delayed)
+                self._push(name, priority)
+            while self.heap_pending and self.heap_pending[0][2] is None:
+                heapq.heappop(self.heap_pending)
+            if self.heap_pending:
+                _, _, name = heapq.heappop(self.heap_pending)
+                del self.dict_pending[name]
+                self.dict_uploading[name] = None
+                return name
+            if self.closed and not self.heap_delayed:
+                return None
+            self.changed.wait(
+                self.heap_delayed and self.heap_delayed[0][0] - now or None)
+
+    def _work(self):
+        while True:
+            with self.mutex:
+                name = self._take()
+            if name is None:
+                break
+            start = time.time()
+            uploaded = 0
+            try:
+                uploaded = self.upload(name) or 0
+            except Exception as e:
+                logger.warning('upload: {} failed: {}'.format(name, e))
+            with self.mutex:
+                self.queue_uploaded.append((time.time(), uploaded))
+                self._prune()
+                self.uploaded_bytes += uploaded
+                priority = self.dict_uploading.pop(name)
+                if priority is not None:
+                    self._push(name, priority)
+                self.changed.notify_all()
+            logger.debug(
+                'upload: {} {} bytes in {:.3f}s, {} queued'.format(
+                    name, uploaded, time.time() - start,
+                    len(self.dict_pending)))
+
+    def cancel(self, name):
+        '''Drop pending upload, return False if not pending'''
+        with self.mutex:
+            entry = self.dict_pending.pop(name, None)
+            if entry is not None:
+                entry[2] = None
+                self.changed.notify_all()
+            return entry is not None
+
+    def close(self):
+        '''Upload everything queued, then stop workers'''
+        with self.mutex:
+            self.closed = True
+            self.changed.notify_all()
+        for worker in self.list_workers:
+            worker.join()
+        logger.info('upload: {}'.format(self.stats()))
+
+    def wait(self, name):
+        '''Block until name is neither queued nor uploading, retries aside'''
+        with self.mutex:
+            while name in self.dict_pending or name in self.dict_uploading:
+                self.changed.wait()
+
+    def enqueue(self, name, priority, delay=0):
+        '''
+        Queue name for upload, a queued name keeps its higher priority
+        Priority is a tuple starting with one of the priority classes
+        '''
+        with self.mutex:
+            if name in self.dict_uploading:
+                # after current upload, it may miss latest changes
+                current_priority = self.dict_uploading[name]
+                if current_priority is None or priority < current_priority:
+                    self.dict_uploading[name] = priority
+            elif delay and self.closed:
+                logger.warning('upload: {} given up'.format(name))
+            elif delay:
+                self.sequence += 1
+                heapq.heappush(self.heap_delayed, (
+                    time.time() + delay, self.sequence, name, priority))
+                self.changed.notify()
+            else:
+                self._push(name, priority)
+
+    def set_dirty(self, name, size):
+        '''Account dirty bytes of name, 0 once clean'''
+        with self.mutex:
+            self.dirty_bytes += size - self.dict_dirty.pop(name, 0)
+            if size:
+                self.dict_dirty[name] = size
+            if self.dirty_bytes <= self.low_water:
+                self.changed.notify_all()
+
+    def stats(self):
+        with self.mutex:
+            self._prune()
+            return {
+                'queued': len(self.dict_pending) + len(self.heap_delayed),
+                'uploading': len(self.dict_uploading),
+                'dirty_bytes': self.dirty_bytes,
+                'uploaded_bytes': self.uploaded_bytes,
+                'throughput': sum(
+                    uploaded for _, uploaded in self.queue_uploaded
+                ) / float(THROUGHPUT_WINDOW),
+            }
+
+    def throttle(self):
+        '''
+        Block writer while dirty bytes are beyond high water, as long as
+        queued uploads can bring them down
+        '''
+        with self.mutex:
+            if self.dirty_bytes <= self.high_water:
+                return
+            while self.dirty_bytes > self.low_water and \
+                    self._pending_bytes() and not self.closed:
+                self.changed.wait()
@@ -0,0 +1,94 @@
+'''
+WriteBack
+Flush dirty objects in background once they have been dirty for too long
+or too much is dirty, whether or not they are still open
+'''
+from __future__ import absolute_import
+
+import time
+from threading import Condition, Lock, Thread
+from .logger import logger
+
+
+class WriteBack:
+    def __init__(self, flush, dirty_age=30, dirty_bytes=1 << 28, interval=5):
+        # flush(name) starts writing name back, mark_clean once done
+        self.flush = flush
+        # seconds an object may stay dirty
+        self.dirty_age = dirty_age
+        # dirty bytes beyond which largest objects are flushed early
+        self.dirty_bytes = dirty_bytes
+        self.interval = interval
+        # name -> [time first dirty, dirty bytes, time last flushed]
+        self.dict_dirty = {}
+        self.total_bytes = 0
+        self.closed = False
+        self.mutex = Lock()
+        self.changed = Condition(self.mutex)
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _due(self):
+        '''
+        Names to flush, oldest and then largest first, a name is flushed
+        at most once every dirty_age
+        '''
+        deadline = time.time() - self.dirty_age
+        list_candidates = [
+            (name, since, size)
+            for name, (since, size, flushed) in self.dict_dirty.items()
+            if flushed <= deadline]
+        list_names = [name for _, name in sorted(
+            (since, name) for name, since, _ in list_candidates
+            if since <= deadline)]
+        total_bytes = self.total_bytes - sum(
+            self.dict_dirty[name][1] for name in list_names)
+        if total_bytes > self.dirty_bytes:
+            for size, name in sorted((
+                    (size, name) for name, since, size in list_candidates
+                    if since > deadline), reverse=True):
+                if total_bytes <= self.dirty_bytes // 2:
+                    break
+                list_names.append(name)
+                total_bytes -= size
+        return list_names
+
+    def _run(self):
+        while True:
+            with self.mutex:
+                if not self.closed:
+                    self.changed.wait(self.interval)
+                if self.closed:
+                    break
+                list_names = self._due()
+                now = time.time()
+                for name in list_names:
+                    self.dict_dirty[name][2] = now
+            for name in list_names:
+                try:
+                    self.flush(name)
+                except Exception as e:
+                    logger.warning('writeback: {} failed: {}'.format(name, e))
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self.changed.notify()
+        self.thread.join()
+
+    def mark_clean(self, name):
+        with self.mutex:
+            entry = self.dict_dirty.pop(name, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def mark_dirty(self, name, size):
+        '''Dirty bytes of name are now size'''
+        with self.mutex:
+            entry = self.dict_dirty.setdefault(name, [time.time(), 0, 0])
+            if self.total_bytes <= self.dirty_bytes < \
+                    self.total_bytes + size - entry[1]:
+                self.changed.notify()
+            self.total_bytes += size - entry[1]
+            entry[1] = size
@@ -3,7 +3,8 @@ from __future__ import absolute_import
 
 import argparse
 import os
-from cpfs.metadata import TmpMetadataConnection, read_metadata, write_metadata
+from cpfs.metadata import MetadataCache, load_metadata, save_metadata, \
+    parser_add_metadata_cache
 from cpfs.storage import parser_add_url, init_storage_operations
 
 
@@ -11,14 +12,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser_add_url(parser)
+    parser_add_metadata_cache(parser)
 
     args = parser.parse_args()
 
     storage_op = init_storage_operations(args.url[0])
-    metadata_conn = TmpMetadataConnection(read_metadata(storage_op))
+    metadata_conn = load_metadata(
+        storage_op, args.metadata_cache and MetadataCache(
+            args.metadata_cache, args.url[0]))
 
     os.system('sqlitebrowser ' + metadata_conn.tmpfile_path)
 
-    write_metadata(storage_op, metadata_conn.dump())
-    metadata_conn.close()
+    save_metadata(storage_op, metadata_conn)
+    metadata_conn.close(True)
     storage_op.destory()
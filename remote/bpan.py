@@ -1,37 +1,80 @@
 from __future__ import absolute_import
 
 import os
+import errno
 import json
+import hashlib
 from time import time
-from threading import Lock, Condition, Event, Thread
+from threading import Lock, Condition
 from collections import defaultdict
-from cpfs.compatibility import BytesIO, urlencode, Request, urlopen, HTTPError
-from cpfs.metadata import METADATA_STORAGE_NAME
-from cpfs.orderedset import OrderedSet
-from cpfs.fragment import FragmentCache
+from multiprocessing.pool import ThreadPool
+from cpfs.compatibility import BytesIO, urlencode, HTTPException
+from cpfs.connectionpool import ConnectionPool
+from cpfs.metadata import METADATA_STORAGE_NAME, METADATA_JOURNAL_NAME, \
+    default_cache_dir
+from cpfs.fragment import FragmentCache, FragmentCacheManager
+from cpfs.uploadscheduler import UploadScheduler, PRIORITY_METADATA, \
+    PRIORITY_SYNC, PRIORITY_BACKGROUND
+from cpfs.writeback import WriteBack
 from cpfs.logger import logger
 
+# seconds before a failed upload is retried
+UPLOAD_RETRY_DELAY = 60
+# error_code of files not existing
+PCS_FILE_NOT_EXIST = 31066
+# entries per page of listing
+LIST_PAGE_SIZE = 1000
+# server errors persisting after retries
+SERVER_ERROR = 500
 
-def encode_multipart(params_dict):
+
+class MultipartBody:
     '''
-    Build a multipart/form-data body with generated random boundary.
+    File-like multipart/form-data body with generated random boundary,
+    file contents are sent from memoryview slices without being copied
     '''
-    boundary = '----%s' % hex(int(time() * 1000))
-    data = []
-    for key, value in params_dict.items():
-        data.append('--{}'.format(boundary))
-        if isinstance(value, str):
-            data.append(
-                'Content-Disposition: form-data; name="{}"\r\n'.format(key))
-            data.append(value)
-        else:
-            data.append(
-                'Content-Disposition: form-data; name="{}"; '
-                'filename="hidden"'.format(key))
-            data.append('Content-Type: application/octet-stream\r\n')
-            data.append(value.decode('ISO-8859-1'))
-    data.append('--{}--\r\n'.format(boundary))
-    return '\r\n'.join(data), boundary
+    def __init__(self, params_dict):
+        self.boundary = '----%s' % hex(int(time() * 1000))
+        self.segments = []
+        for key, value in params_dict.items():
+            if isinstance(value, str):
+                self.segments.append((
+                    '--{}\r\nContent-Disposition: form-data; name="{}"'
+                    '\r\n\r\n{}\r\n'.format(self.boundary, key, value)
+                ).encode('utf-8'))
+            else:
+                self.segments.append((
+                    '--{}\r\nContent-Disposition: form-data; name="{}"; '
+                    'filename="hidden"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n'.format(
+                        self.boundary, key)).encode('utf-8'))
+                self.segments.append(memoryview(value))
+                self.segments.append(b'\r\n')
+        self.segments.append('--{}--\r\n'.format(self.boundary).encode())
+        self.length = sum(len(segment) for segment in self.segments)
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        list_chunks = []
+        while self.index < len(self.segments) and size:
+            segment = self.segments[self.index]
+            end = len(segment) if size < 0 else min(
+                len(segment), self.offset + size)
+            list_chunks.append(segment[self.offset:end])
+            size -= end - self.offset
+            self.offset = end
+            if self.offset == len(segment):
+                self.index += 1
+                self.offset = 0
+        return b''.join(list_chunks)
+
+    def seek(self, offset):
+        '''Only rewinding is supported'''
+        self.index = 0
+        self.offset = 0
 
 
 class StorageOperations:
@@ -43,31 +86,75 @@ class StorageOperations:
         self.quota = (0, (0, 0))
         self.destroyed = False
         self.dry_run = 'ro' in additional_options
+        '''
+        cache_size: memory for cached fragments of all files
+        cache_dir: where fragments beyond cache_size are spilled
+        pool_size: connections per host
+        pool_idle: seconds an idle connection is kept
+        retries: retries of failed requests
+        part_size: files larger are uploaded in parts of part_size
+        part_workers: parts of a file uploaded at once
+        upload_workers: files uploaded at once
+        dirty_size: dirty bytes writers are blocked beyond
+        dirty_age: seconds an opened file may stay dirty before uploaded
+        writeback_size: dirty bytes beyond which largest opened files are
+            uploaded early
+        base_url: PCS server, e.g. http://127.0.0.1:8080 of a stand-in
+        upload_url: server files are uploaded to, base_url if it is set
+        download_url: server files are downloaded from, base_url if it is
+            set
+        '''
+        base_url = additional_options.get('base_url')
+        self.pcs_url = base_url or 'https://pcs.baidu.com'
+        self.upload_url = additional_options.get(
+            'upload_url', base_url or 'https://c.pcs.baidu.com')
+        self.download_url = additional_options.get(
+            'download_url', base_url or 'https://d.pcs.baidu.com')
+        self.part_size = int(additional_options.get('part_size', 1 << 24))
+        self.part_workers = int(additional_options.get('part_workers', 4))
+        self.part_pool = ThreadPool(self.part_workers)
+        # name -> {part index: md5 of part already uploaded}
+        self.dict_uploaded_parts = defaultdict(dict)
+        self.pool = ConnectionPool(
+            int(additional_options.get('pool_size', 8)),
+            float(additional_options.get('pool_idle', 60)),
+            int(additional_options.get('retries', 3)))
 
         # blob control
         self.dict_files_buffer = {}
         self.set_new_files = set()
+        self.set_opened_files = set()
+        self.cache_manager = FragmentCacheManager(
+            int(additional_options.get('cache_size', 1 << 28)),
+            additional_options.get('cache_dir') or
+            os.path.join(default_cache_dir(), 'fragments'))
         # upload control
         self.mutex = Lock()
-        self.all_jobs_done = Event()
-        self.new_job = Event()
-        self.queue_pending_files = OrderedSet()
-
-        upload_thread = Thread(target=self._upload)
-        upload_thread.start()
+        self.scheduler = UploadScheduler(
+            self._upload, int(additional_options.get('upload_workers', 4)),
+            int(additional_options.get('dirty_size', 1 << 30)))
+        self.writeback = WriteBack(
+            self._write_back, float(additional_options.get('dirty_age', 30)),
+            int(additional_options.get(
+                'writeback_size', self.scheduler.high_water // 4)))
+        # name -> error of last failed upload
+        self.dict_upload_errors = {}
 
     def _get(self, base_url, parameters, headers=None):
+        status, result, _ = self._get_response(base_url, parameters, headers)
+        if status >= SERVER_ERROR:
+            raise IOError('bpan: get {} failed: {}'.format(base_url, result))
+        return result
+
+    def _get_response(self, base_url, parameters, headers=None):
+        '''Return (status, body, headers) of response'''
         logger.debug(
             'bpan: get(base_url={}, parameters={}, headers={})'.format(
                 base_url, parameters, headers))
         parameters['access_token'] = self.access_token
-        req = Request('?'.join((base_url, urlencode(parameters))))
-        if headers:
-            req.headers.update(headers)
-        try:
-            return urlopen(req).read()
-        except HTTPError as e:
-            return e.read()
+        return self.pool.request(
+            'GET', '?'.join((base_url, urlencode(parameters))),
+            headers=headers)
 
     def _path(self, name):
         return '/'.join((self.app_path, name))
@@ -76,7 +163,9 @@ class StorageOperations:
     def _json(result):
         return json.loads(result.decode())
 
-    def _post(self, base_url, parameters, data=b'', headers=None):
+    def _post(self, base_url, parameters, data=b'', headers=None,
+              idempotent=False):
+        '''Requests are retried after a failure only if idempotent'''
         logger.debug(
             'bpan: post(base_url={}, parameters={}, headers={})'.format(
                 base_url, parameters, headers))
@@ -84,121 +173,269 @@ class StorageOperations:
             logger.debug('bpan: dry_run')
             return b''
         parameters['access_token'] = self.access_token
+        headers = dict(headers or {})
         if data:
-            data, boundary = encode_multipart(data)
-            req = Request(
-                '?'.join((base_url, urlencode(parameters))),
-                data.encode('ISO-8859-1'))
-            req.add_header(
-                'Content-Type', 'multipart/form-data; boundary=%s' % boundary)
+            data = MultipartBody(data)
+            headers['Content-Type'] = \
+                'multipart/form-data; boundary=%s' % data.boundary
+            headers['Content-Length'] = str(len(data))
         else:
-            req = Request(
-                '?'.join((base_url, urlencode(parameters))), data)
-        if headers:
-            req.headers.update(headers)
-        try:
-            return urlopen(req).read()
-        except HTTPError as e:
-            return e.read()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return self.pool.request(
+            'POST', '?'.join((base_url, urlencode(parameters))), data,
+            headers, idempotent)[1]
 
     def _read_factory(self, name):
         path = self._path(name)
 
         def read_factory(offset, length):
-            return self._get(
-                'https://d.pcs.baidu.com/rest/2.0/pcs/file',
+            status, result, headers = self._get_response(
+                self.download_url + '/rest/2.0/pcs/file',
                 {'method': 'download', 'path': path},
                 headers={
                     'Range': 'bytes={}-{}'.format(offset, offset + length - 1)
                 })
+            # error bodies must never be taken as content
+            if status == 200:
+                # range ignored, whole object sent
+                return result[offset:offset + length]
+            # body must be the range asked for, shorter only at end
+            content_range = 'bytes {}-{}'.format(
+                offset, offset + len(result) - 1)
+            if status != 206 or len(result) > length or headers.get(
+                    'content-range', '').split('/', 1)[0] != content_range:
+                raise IOError('bpan: download {} at {} failed: {} {}'.format(
+                    name, offset, status, result[:256]))
+            return result
 
         return read_factory
 
-    def _upload(self):
-        last_wake = time()
-        while True:
-            if not self.queue_pending_files:
-                while time() < last_wake + 600 and not self.destroyed:
-                    self.new_job.wait()
-                last_wake = time()
-                self.new_job.clear()
-            while self.queue_pending_files:
-                with self.mutex:
-                    name = self.queue_pending_files.pop(False)
-                    self.dict_files_buffer[name].mutex.acquire()
-                logger.debug(self._post(
-                    'https://c.pcs.baidu.com/rest/2.0/pcs/file',
-                    {
-                        'method': 'upload', 'path': self._path(name),
-                        'ondup': 'overwrite'},
-                    {'file': self.dict_files_buffer[name].read(
-                        0, self.size(name))}))
-                self.dict_files_buffer[name].dirty = False
+    def _upload_file(self, name, file_buffer):
+        '''Return generation of uploaded content'''
+        if len(file_buffer) <= self.part_size:
+            buf, generation = file_buffer.snapshot()
+            result = self._post(
+                self.upload_url + '/rest/2.0/pcs/file',
+                {
+                    'method': 'upload', 'path': self._path(name),
+                    'ondup': 'overwrite'},
+                {'file': buf}, idempotent=True)
+            logger.debug(result)
+            if not self.dry_run and 'error_code' in self._json(result):
+                raise IOError('bpan: upload {} failed: {}'.format(
+                    name, result))
+            return generation
+        list_parts = self.part_pool.map(
+            lambda index: self._upload_part(name, file_buffer, index),
+            range(-(-len(file_buffer) // self.part_size)))
+        result = self._post(
+            self.pcs_url + '/rest/2.0/pcs/file',
+            {
+                'method': 'createsuperfile', 'path': self._path(name),
+                'ondup': 'overwrite'},
+            {'param': json.dumps(
+                {'block_list': [md5 for md5, _ in list_parts]})},
+            idempotent=True)
+        if not self.dry_run and 'error_code' in self._json(result):
+            raise IOError('bpan: merge {} failed: {}'.format(name, result))
+        self.dict_uploaded_parts.pop(name, None)
+        return min(generation for _, generation in list_parts)
+
+    def _upload_part(self, name, file_buffer, index):
+        '''Return (md5, generation) of part, skip if uploaded already'''
+        buf, generation = file_buffer.snapshot(
+            index * self.part_size, self.part_size)
+        md5 = hashlib.md5(buf).hexdigest()
+        dict_parts = self.dict_uploaded_parts[name]
+        if dict_parts.get(index) != md5:
+            result = self._post(
+                self.upload_url + '/rest/2.0/pcs/file',
+                {'method': 'upload', 'type': 'tmpfile'}, {'file': buf},
+                idempotent=True)
+            if not self.dry_run and self._json(result).get('md5') != md5:
+                raise IOError('bpan: upload part {} of {} failed: {}'.format(
+                    index, name, result))
+            dict_parts[index] = md5
+        return md5, generation
+
+    @staticmethod
+    def _priority(name, size, sync=False):
+        if name in (METADATA_STORAGE_NAME, METADATA_JOURNAL_NAME):
+            return PRIORITY_METADATA, size
+        return sync and PRIORITY_SYNC or PRIORITY_BACKGROUND, size
+
+    def _upload(self, name):
+        '''Return bytes uploaded'''
+        with self.mutex:
+            file_buffer = self.dict_files_buffer.get(name)
+        if file_buffer is None:
+            return 0
+        size = len(file_buffer)
+        # file stays writable while uploading
+        try:
+            clean = file_buffer.set_clean(
+                self._upload_file(name, file_buffer))
+        except (IOError, ValueError, HTTPException) as e:
+            logger.warning('bpan: upload {} failed: {}'.format(name, e))
+            with self.mutex:
+                if self.dict_files_buffer.get(name) is file_buffer:
+                    self.dict_upload_errors[name] = e
+                    self.scheduler.enqueue(
+                        name, self._priority(name, size), UPLOAD_RETRY_DELAY)
+            return 0
+        with self.mutex:
+            removed = self.dict_files_buffer.get(name) is not file_buffer
+            if removed:
+                self.dict_uploaded_parts.pop(name, None)
+            else:
                 self.set_new_files.discard(name)
-                self.dict_files_buffer[name].mutex.release()
-            if self.destroyed:
-                break
-        self.all_jobs_done.set()
+                self.dict_upload_errors.pop(name, None)
+                if clean:
+                    self.scheduler.set_dirty(name, 0)
+                    self.writeback.mark_clean(name)
+                if name not in self.set_opened_files:
+                    if clean:
+                        self.dict_files_buffer.pop(name).close()
+                    else:
+                        # modified while uploading
+                        self.scheduler.enqueue(
+                            name, self._priority(name, len(file_buffer)))
+        if removed:
+            self._post(
+                self.pcs_url + '/rest/2.0/pcs/file',
+                {'method': 'delete', 'path': self._path(name)})
+        return size
+
+    def _write_back(self, name):
+        with self.mutex:
+            file_buffer = self.dict_files_buffer.get(name)
+        if file_buffer is not None and file_buffer.dirty and len(file_buffer):
+            self.scheduler.enqueue(
+                name, self._priority(name, len(file_buffer)))
 
     def close(self, name):
+        with self.mutex:
+            self.set_opened_files.discard(name)
         if self.dict_files_buffer[name].dirty:
             if len(self.dict_files_buffer[name]):
-                with self.mutex:
-                    self.queue_pending_files.discard(name)
-                    self.queue_pending_files.add(name)
-                self.new_job.set()
+                self.scheduler.enqueue(name, self._priority(
+                    name, len(self.dict_files_buffer[name])))
             else:
                 self.remove(name)
+        else:
+            with self.mutex:
+                self.dict_files_buffer.pop(name).close()
 
     def create(self, name):
         self.set_new_files.add(name)
 
     def destory(self):
         self.destroyed = True
-        self.new_job.set()
-        self.all_jobs_done.wait()
+        self.writeback.close()
+        self.scheduler.close()
+        self.part_pool.terminate()
+        self.pool.close()
 
     def flush(self, name):
-        pass
+        # closed and uploaded already
+        file_buffer = self.dict_files_buffer.get(name)
+        if file_buffer is None:
+            return
+        if file_buffer.dirty and len(file_buffer):
+            self.scheduler.enqueue(
+                name, self._priority(name, len(file_buffer), True))
+
+    def list_objects(self):
+        '''Yield (name, size) of every object, pages fetched in parallel'''
+        def list_page(page):
+            return self._json(self._get(
+                self.pcs_url + '/rest/2.0/pcs/file', {
+                    'method': 'list', 'path': self.app_path, 'by': 'name',
+                    'limit': '{}-{}'.format(
+                        page * LIST_PAGE_SIZE, (page + 1) * LIST_PAGE_SIZE)
+                })).get('list', [])
+
+        page = 0
+        while True:
+            list_pages = self.part_pool.map(
+                list_page, range(page, page + self.part_workers))
+            for entries in list_pages:
+                for entry in entries:
+                    if not entry.get('isdir'):
+                        yield entry['path'].rsplit('/', 1)[-1], entry['size']
+            if any(len(entries) < LIST_PAGE_SIZE for entries in list_pages):
+                break
+            page += self.part_workers
+
+    def _meta_size(self, name):
+        result = self._json(self._get(
+            self.pcs_url + '/rest/2.0/pcs/file',
+            {'method': 'meta', 'path': self._path(name)}))
+        if 'error_code' in result:
+            raise IOError(
+                result['error_code'] == PCS_FILE_NOT_EXIST and
+                errno.ENOENT or errno.EIO,
+                'bpan: meta {} failed: {}'.format(name, result))
+        return result['list'][0]['size']
 
     def open(self, name, attr=None):
-        with self.mutex:
-            if name in self.queue_pending_files:
-                self.queue_pending_files.discard(name)
         if name not in self.dict_files_buffer:
-            self.dict_files_buffer[name] = FragmentCache(
-                self._read_factory(name))
+            # fails before anything is recorded if object is missing
             if name in self.set_new_files:
-                self.dict_files_buffer[name].dirty = True
-                self.dict_files_buffer[name].length = 0
+                length = 0
             elif attr:
-                self.dict_files_buffer[name].length = attr.st_size
+                length = attr.st_size
             else:
-                self.dict_files_buffer[name].length = self._json(self._get(
-                    'https://pcs.baidu.com/rest/2.0/pcs/file',
-                    {'method': 'meta', 'path': self._path(name)}
-                ))['list'][0]['size']
+                length = self._meta_size(name)
+            file_buffer = FragmentCache(
+                self._read_factory(name), self.cache_manager, length)
+            file_buffer.dirty = name in self.set_new_files
+            self.dict_files_buffer[name] = file_buffer
+        self.scheduler.cancel(name)
+        with self.mutex:
+            self.set_opened_files.add(name)
 
     def read(self, name, offset, length):
         return self.dict_files_buffer[name].read(offset, length)
 
     def remove(self, name):
-        with self.dict_files_buffer[name].mutex:
+        try:
+            self.remove_many([name])
+        except IOError as e:
+            logger.warning(e)
+
+    def remove_many(self, names):
+        '''Remove objects with one request, opened or not'''
+        list_paths = []
+        for name in names:
+            self.scheduler.cancel(name)
+            self.scheduler.set_dirty(name, 0)
+            self.writeback.mark_clean(name)
             with self.mutex:
-                if name in self.queue_pending_files:
-                    self.queue_pending_files.discard(name)
-            if name in self.set_new_files:
+                self.set_opened_files.discard(name)
+                file_buffer = self.dict_files_buffer.pop(name, None)
+                self.dict_uploaded_parts.pop(name, None)
+                self.dict_upload_errors.pop(name, None)
+                new = name in self.set_new_files
                 self.set_new_files.discard(name)
-            else:
-                self._post(
-                    'https://pcs.baidu.com/rest/2.0/pcs/file',
-                    {'method': 'delete', 'path': self._path(name)})
-            del self.dict_files_buffer[name]
+            if file_buffer is not None:
+                file_buffer.close()
+            if not new:
+                list_paths.append({'path': self._path(name)})
+        if not list_paths:
+            return
+        result = self._post(
+            self.pcs_url + '/rest/2.0/pcs/file', {'method': 'delete'},
+            {'param': json.dumps({'list': list_paths})})
+        # already deleted before a crash
+        if not self.dry_run and self._json(result).get(
+                'error_code', PCS_FILE_NOT_EXIST) != PCS_FILE_NOT_EXIST:
+            raise IOError('bpan: delete failed: {}'.format(result))
 
     def statfs(self):
         if time() > self.quota[0] + 600:
             result = self._json(self._get(
-                'https://pcs.baidu.com/rest/2.0/pcs/quota',
+                self.pcs_url + '/rest/2.0/pcs/quota',
                 {'method': 'info'}))
             self.quota = (time(), (result['used'], result['quota']))
         return self.quota[1]
@@ -206,8 +443,37 @@ class StorageOperations:
     def size(self, name):
         return len(self.dict_files_buffer[name])
 
+    def sync(self, name):
+        '''Block until current content of name is uploaded'''
+        file_buffer = self.dict_files_buffer.get(name)
+        if file_buffer is None or not file_buffer.dirty or \
+                not len(file_buffer):
+            return
+        generation = file_buffer.generation
+        while file_buffer.synced_generation < generation:
+            with self.mutex:
+                if self.dict_files_buffer.get(name) is not file_buffer:
+                    return
+                self.dict_upload_errors.pop(name, None)
+            self.scheduler.enqueue(
+                name, self._priority(name, len(file_buffer), True))
+            self.scheduler.wait(name)
+            with self.mutex:
+                error = self.dict_upload_errors.get(name)
+            if error is not None:
+                raise IOError('bpan: sync {} failed: {}'.format(name, error))
+
     def truncate(self, name, length):
-        return self.dict_files_buffer[name].truncate(length)
+        file_buffer = self.dict_files_buffer[name]
+        file_buffer.truncate(length)
+        self.scheduler.set_dirty(name, file_buffer.dirty_bytes)
+        self.writeback.mark_dirty(name, file_buffer.dirty_bytes)
+        return length
 
     def write(self, name, offset, buf):
-        return self.dict_files_buffer[name].write(offset, buf)
+        self.scheduler.throttle()
+        file_buffer = self.dict_files_buffer[name]
+        file_buffer.write(offset, buf)
+        self.scheduler.set_dirty(name, file_buffer.dirty_bytes)
+        self.writeback.mark_dirty(name, file_buffer.dirty_bytes)
+        return len(buf)
@@ -1,50 +1,241 @@
+import errno
 import os
+import mmap
+from collections import OrderedDict
+from threading import Lock
+from cpfs.writeback import WriteBack
+
+# consecutive sequential reads before the kernel is told to read ahead more
+SEQUENTIAL_READS = 4
+
+
+class Descriptor:
+    '''Open descriptor of an object, shared by everyone opening it'''
+    def __init__(self, fd):
+        self.fd = fd
+        # size of file, kept up to date by writes and truncates
+        self.size = os.fstat(fd).st_size
+        # opened and not closed yet, never evicted while positive
+        self.refcount = 0
+        self.map = None
+        # offset next read starts at if access is sequential
+        self.next_offset = 0
+        self.sequential_reads = 0
+        # held while map is used or replaced, so truncate never leaves
+        # a reader on pages beyond the end of file
+        self.mutex = Lock()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+
+
+def pread(fd, length, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def pwrite(fd, buf, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, buf, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, buf)
 
 
 class StorageOperations:
-    '''Local storage with terrible performance'''
+    '''
+    Local storage, descriptors of opened objects and of recently used ones
+    are kept open and accessed without seeking
+    '''
     def __init__(self, hostname, path, username, password,
-                 **additional_options):
+                 additional_options):
         if not os.path.isdir(path):
             raise ValueError("'{}' not a directory\n".format(path))
         self.path = path
+        '''
+        dirty_age: seconds a written file may stay unsynced
+        writeback_size: unsynced bytes beyond which largest files are synced
+        fd_cache: descriptors kept open after objects are closed
+        mmap_size: files at least as large are read through mmap, 0 to
+            disable
+        '''
+        self.writeback = WriteBack(
+            self.sync, float(additional_options.get('dirty_age', 30)),
+            int(additional_options.get('writeback_size', 1 << 28)))
+        self.fd_cache = int(additional_options.get('fd_cache', 256))
+        self.mmap_size = int(additional_options.get('mmap_size', 1 << 20))
+        # name -> Descriptor, least recently used first
+        self.dict_descriptors = OrderedDict()
+        self.mutex = Lock()
+
+    def _acquire(self, name):
+        '''Descriptor of name, pinned until released'''
+        with self.mutex:
+            descriptor = self.dict_descriptors.pop(name, None)
+            if descriptor is None:
+                descriptor = Descriptor(
+                    os.open(os.path.join(self.path, name), os.O_RDWR))
+            self.dict_descriptors[name] = descriptor
+            descriptor.refcount += 1
+            return descriptor
+
+    def _release(self, descriptor):
+        list_evicted = []
+        with self.mutex:
+            descriptor.refcount -= 1
+            if len(self.dict_descriptors) > self.fd_cache:
+                for name, cached in list(self.dict_descriptors.items()):
+                    if len(self.dict_descriptors) <= self.fd_cache:
+                        break
+                    if not cached.refcount:
+                        del self.dict_descriptors[name]
+                        list_evicted.append(cached)
+        for evicted in list_evicted:
+            evicted.close()
+
+    def _advise(self, descriptor, offset, length):
+        '''Ask for more read ahead while reads are sequential'''
+        if offset == descriptor.next_offset:
+            descriptor.sequential_reads += 1
+            if descriptor.sequential_reads == SEQUENTIAL_READS:
+                os.posix_fadvise(
+                    descriptor.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        else:
+            if descriptor.sequential_reads >= SEQUENTIAL_READS:
+                os.posix_fadvise(descriptor.fd, 0, 0, os.POSIX_FADV_NORMAL)
+            descriptor.sequential_reads = 0
+        descriptor.next_offset = offset + length
+
+    def _read_mapped(self, descriptor, offset, length):
+        '''Read through mmap, None if file is too small to be mapped'''
+        with descriptor.mutex:
+            if descriptor.map is None or \
+                    len(descriptor.map) < offset + length:
+                size = os.fstat(descriptor.fd).st_size
+                if size < self.mmap_size:
+                    return None
+                if descriptor.map is None or len(descriptor.map) < size:
+                    if descriptor.map is not None:
+                        descriptor.map.close()
+                    descriptor.map = mmap.mmap(
+                        descriptor.fd, size, access=mmap.ACCESS_READ)
+            return descriptor.map[offset:offset + length]
 
     def close(self, name):
-        pass
+        with self.mutex:
+            descriptor = self.dict_descriptors.get(name)
+        if descriptor is not None:
+            self._release(descriptor)
 
     def create(self, name):
         os.mknod(os.path.join(self.path, name))
 
     def destory(self):
-        pass
+        self.writeback.close()
+        with self.mutex:
+            list_descriptors = list(self.dict_descriptors.values())
+            self.dict_descriptors.clear()
+        for descriptor in list_descriptors:
+            descriptor.close()
 
     def flush(self, name):
         pass
 
     def read(self, name, offset, length):
-        file_path = os.path.join(self.path, name)
-        with open(file_path, 'rb') as file_handle:
-            file_handle.seek(offset)
-            return file_handle.read(length)
+        descriptor = self._acquire(name)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                self._advise(descriptor, offset, length)
+            buf = None
+            if self.mmap_size:
+                buf = self._read_mapped(descriptor, offset, length)
+            if buf is None:
+                buf = pread(descriptor.fd, length, offset)
+            return buf
+        finally:
+            self._release(descriptor)
+
+    def list_objects(self):
+        '''Yield (name, size) of every object'''
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if os.path.isfile(file_path):
+                yield name, os.stat(file_path).st_size
 
     def open(self, name):
-        pass
+        self._acquire(name)
 
     def remove(self, name):
+        self.writeback.mark_clean(name)
+        with self.mutex:
+            descriptor = self.dict_descriptors.pop(name, None)
+        if descriptor is not None:
+            descriptor.close()
         os.remove(os.path.join(self.path, name))
 
+    def remove_many(self, names):
+        '''Remove objects, opened or not, missing ones are skipped'''
+        for name in names:
+            try:
+                self.remove(name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
     def size(self, name):
+        with self.mutex:
+            descriptor = self.dict_descriptors.get(name)
+            if descriptor is not None:
+                return descriptor.size
         return os.stat(os.path.join(self.path, name)).st_size
 
     def statfs(self):
         return (100, 10000)
 
+    def sync(self, name):
+        '''Block until written content of name is on disk'''
+        self.writeback.mark_clean(name)
+        try:
+            descriptor = self._acquire(name)
+        except OSError as e:
+            # removed meanwhile, nothing to sync
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            os.fsync(descriptor.fd)
+        finally:
+            self._release(descriptor)
+
     def truncate(self, name, length):
-        with open(os.path.join(self.path, name), 'ab') as file_handle:
-            file_handle.truncate(length)
+        descriptor = self._acquire(name)
+        try:
+            with descriptor.mutex:
+                if descriptor.map is not None and \
+                        len(descriptor.map) > length:
+                    descriptor.map.close()
+                    descriptor.map = None
+                os.ftruncate(descriptor.fd, length)
+                descriptor.size = length
+        finally:
+            self._release(descriptor)
+        self.writeback.mark_dirty(name, length)
 
     def write(self, name, offset, buf):
-        with open(os.path.join(self.path, name), 'rb+') as file_handle:
-            file_handle.seek(offset)
-            file_handle.write(buf)
+        descriptor = self._acquire(name)
+        try:
+            position = pwrite(descriptor.fd, buf, offset)
+            while position < len(buf):
+                position += pwrite(
+                    descriptor.fd, buf[position:], offset + position)
+            with descriptor.mutex:
+                descriptor.size = size = max(
+                    descriptor.size, offset + len(buf))
+        finally:
+            self._release(descriptor)
+        self.writeback.mark_dirty(name, size)
         return len(buf)
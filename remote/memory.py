@@ -0,0 +1,77 @@
+import errno
+from threading import Lock
+
+
+class StorageOperations:
+    '''
+    Objects kept in memory and lost on exit, a baseline free of backend
+    costs for benchmarks
+    '''
+    def __init__(self, hostname, path, username, password,
+                 additional_options):
+        '''
+        quota: bytes reported as total by statfs
+        '''
+        self.quota = int(additional_options.get('quota', 1 << 40))
+        # name -> content
+        self.dict_objects = {}
+        self.mutex = Lock()
+
+    def close(self, name):
+        pass
+
+    def create(self, name):
+        with self.mutex:
+            self.dict_objects.setdefault(name, bytearray())
+
+    def destory(self):
+        pass
+
+    def flush(self, name):
+        pass
+
+    def list_objects(self):
+        '''Yield (name, size) of every object'''
+        with self.mutex:
+            list_objects = [
+                (name, len(data)) for name, data in self.dict_objects.items()]
+        return iter(list_objects)
+
+    def open(self, name, attr=None):
+        if name not in self.dict_objects:
+            raise IOError(errno.ENOENT, "'{}' not found".format(name))
+
+    def read(self, name, offset, length):
+        return bytes(self.dict_objects[name][offset:offset + length])
+
+    def remove(self, name):
+        with self.mutex:
+            del self.dict_objects[name]
+
+    def remove_many(self, names):
+        with self.mutex:
+            for name in names:
+                self.dict_objects.pop(name, None)
+
+    def size(self, name):
+        return len(self.dict_objects[name])
+
+    def statfs(self):
+        with self.mutex:
+            used = sum(len(data) for data in self.dict_objects.values())
+        return (used, self.quota)
+
+    def truncate(self, name, length):
+        data = self.dict_objects[name]
+        with self.mutex:
+            del data[length:]
+            data += b'\0' * (length - len(data))
+        return length
+
+    def write(self, name, offset, buf):
+        data = self.dict_objects[name]
+        with self.mutex:
+            if len(data) < offset:
+                data += b'\0' * (offset - len(data))
+            data[offset:offset + len(buf)] = buf
+        return len(buf)